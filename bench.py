@@ -0,0 +1,334 @@
+# Offline load test for the mention pipeline. Starts a local HyperCLOVA stand-in, then for
+# each dataset size runs main.py in a fresh process against a generated data set and feeds
+# synthetic mentions through on_message:
+#
+#     python bench.py --sizes 1000,10000,100000,1000000 --backend sqlite --latency-ms 300
+#
+# Results are printed and written to bench_output.txt.
+import argparse
+import asyncio
+import contextlib
+import importlib
+import io
+import json
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import urllib.request
+
+from aiohttp import web
+
+BOT_ID = 900000000000000001
+REPLY_TEXT = "벤치마크 응답이야! 오늘도 좋은 하루 보내."
+TOPICS = ["사과", "고양이", "축구", "피아노", "여행", "커피", "코딩", "영화", "등산", "라면", "바다", "게임"]
+VERBS = ["좋아한다", "싫어한다", "자주 한다", "배우고 있다", "키우고 있다", "매일 생각한다"]
+QUESTIONS = ["{topic} 좋아해?", "오늘 {topic} 얘기 해줄래?", "내가 {topic} 좋아하는 거 기억나?", "심심한데 뭐 하지?", "{topic}에 대해 어떻게 생각해?"]
+MEMORIES_PER_USER = 4
+
+# Local stand-in for the HyperCLOVA chat-completions endpoint.
+
+def serve(args):
+    stats = {"calls": 0, "throttled": 0, "streamed": 0}
+
+    async def chat(request):
+        stats["calls"] += 1
+        body = await request.json()
+        if random.random() < args.rate_limit:
+            stats["throttled"] += 1
+            return web.json_response({"status": {"code": "42901", "message": "Too Many Requests"}}, status=429, headers={"Retry-After": "1"})
+        latency = max(0.0, random.gauss(args.latency_ms, args.latency_ms * args.jitter)) / 1000
+        if body.get("maxTokens") == 2:
+            content = "1"
+        elif body.get("maxTokens") == 256:
+            content = "N"
+        else:
+            content = REPLY_TEXT
+        if request.headers.get("Accept") != "text/event-stream":
+            await asyncio.sleep(latency)
+            return web.json_response({"status": {"code": "20000"}, "result": {"message": {"role": "assistant", "content": content}}})
+        stats["streamed"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        tokens = content.split(" ")
+        await asyncio.sleep(latency / 2)
+        try:
+            for index, token in enumerate(tokens):
+                delta = token if index == 0 else " " + token
+                await response.write(f"event: token\ndata: {json.dumps({'message': {'role': 'assistant', 'content': delta}}, ensure_ascii=False)}\n\n".encode("utf-8"))
+                await asyncio.sleep(latency / 2 / len(tokens))
+            await response.write(f"event: result\ndata: {json.dumps({'message': {'role': 'assistant', 'content': content}}, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await response.write_eof()
+        except ConnectionResetError:
+            # The bot gave up on the request (deadline or shutdown).
+            pass
+        return response
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/serviceapp/v1/chat-completions/{model}", chat)
+    app.router.add_get("/stats", get_stats)
+    web.run_app(app, host="127.0.0.1", port=args.port, print=None)
+
+def server_stats(host):
+    with urllib.request.urlopen(f"{host}/stats") as response:
+        return json.load(response)
+
+# Dataset generation. Memories are written straight into a version 2 data.json; the
+# SQLite dataset is produced from it with main.py's own migrator.
+
+def build_dataset(directory, memory_count, guild_count, model, backend):
+    user_count = max(1, math.ceil(memory_count / MEMORIES_PER_USER))
+    now = int(time.time())
+    rows = []
+    for memory_id in range(1, memory_count + 1):
+        user_index = (memory_id - 1) // MEMORIES_PER_USER
+        guild_id = 1000 + user_index % guild_count
+        text = f"{random.choice(TOPICS)}을(를) {random.choice(VERBS)}"
+        rows.append([memory_id, guild_id, 5000 + user_index, "사용자", text, now - random.randint(0, 3600), 0])
+    guilds = [str(1000 + index) for index in range(guild_count)]
+    data = {
+        "ServerTokens": {guild_id: {"tokens": 10 ** 9, "gived": True} for guild_id in guilds},
+        "ServerModels": {guild_id: model for guild_id in guilds},
+        "ServerEveryoneResponse": {guild_id: True for guild_id in guilds},
+        "LongTermMemoryVersion": 2,
+        "LongTermMemory": rows,
+        "NextMemoryId": memory_count + 1,
+    }
+    with open(os.path.join(directory, "data.json"), "w", encoding="utf-8") as file:
+        json.dump(data, file, ensure_ascii=False)
+    if backend == "sqlite":
+        env = {**os.environ, "DOHARU_STORAGE_BACKEND": "json"}
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), "migrate-sqlite"], cwd=directory, env=env, check=True, stdout=subprocess.DEVNULL)
+        os.remove(os.path.join(directory, "data.json"))
+    return user_count
+
+# Synthetic Discord objects, just enough for on_message and the reply path.
+
+class FakeSentMessage:
+    async def edit(self, content=None, **kwargs):
+        pass
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.replies = asyncio.Queue()
+
+    def typing(self):
+        return contextlib.nullcontext()
+
+    async def send(self, content=None, **kwargs):
+        self.replies.put_nowait((time.monotonic(), content))
+        return FakeSentMessage()
+
+def fake_message(channel, guild_id, user_id, content):
+    return types.SimpleNamespace(
+        id=random.getrandbits(60),
+        content=f"<@{BOT_ID}> {content}",
+        author=types.SimpleNamespace(id=user_id, bot=False, nick=None, name=f"user{user_id}", mention=f"<@{user_id}>"),
+        guild=types.SimpleNamespace(id=guild_id),
+        channel=channel,
+        mention_everyone=False,
+        reply=channel.send,
+        _state=None,
+    )
+
+def written_bytes():
+    # Bytes handed to write() by this process: journal, snapshots and SQLite pages.
+    # stdout is swallowed in Python during the run, so it does not count.
+    try:
+        with open("/proc/self/io", "r") as file:
+            for line in file:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def percentile(samples, percent):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+async def drive(main, args, user_count, guild_count):
+    main.storage.start()
+    main.memory_workers.start()
+    tasks = [asyncio.create_task(main.monitor_event_loop_lag()), asyncio.create_task(main.token_ledger.run_settlement())]
+    calls_before = server_stats(args.host)["calls"]
+    bytes_before = written_bytes()
+    latencies = []
+    errors = 0
+    remaining = args.mentions
+
+    async def simulated_user(index):
+        nonlocal remaining, errors
+        channel = FakeChannel(10 ** 6 + index)
+        while remaining > 0:
+            remaining -= 1
+            user_index = random.randrange(user_count)
+            question = random.choice(QUESTIONS).format(topic=random.choice(TOPICS))
+            sent = time.monotonic()
+            await main.on_message(fake_message(channel, 1000 + user_index % guild_count, 5000 + user_index, question))
+            try:
+                replied, content = await asyncio.wait_for(channel.replies.get(), args.timeout)
+            except asyncio.TimeoutError:
+                errors += 1
+                continue
+            latencies.append(replied - sent)
+            if not content or not REPLY_TEXT.startswith(content.split(" ")[0]):
+                errors += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(simulated_user(index) for index in range(args.concurrency)))
+    elapsed = time.monotonic() - started
+    await main.memory_workers.drain(main.MEMORY_DRAIN_TIMEOUT)
+    await main.token_ledger.settle()
+    await main.storage.close()
+    await main.completion_executor.close()
+    for task in tasks:
+        task.cancel()
+    calls = server_stats(args.host)["calls"] - calls_before
+    bytes_after = written_bytes()
+    return {
+        "mentions": args.mentions,
+        "errors": errors,
+        "throughput": args.mentions / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "loop_lag_p99": main.loop_lag.percentile(99) if main.loop_lag.samples else 0.0,
+        "loop_lag_max": max(main.loop_lag.samples) if main.loop_lag.samples else 0.0,
+        "api_calls_per_mention": calls / args.mentions,
+        "bytes_per_mention": (bytes_after - bytes_before) / args.mentions if bytes_before is not None else None,
+        "startup": main.startup_marks.get("storage loaded", 0.0),
+    }
+
+def run_child(args):
+    real_stdout = sys.stdout
+    os.chdir(args.workdir)
+    os.environ["HYPERCLOVA_HOST"] = args.host
+    os.environ["DOHARU_STORAGE_BACKEND"] = args.backend
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    # main prints a line per mention; keep that out of the report and the byte count.
+    sys.stdout = io.StringIO()
+    try:
+        main = importlib.import_module("main")
+        main.bot._connection.user = types.SimpleNamespace(id=BOT_ID, mention=f"<@{BOT_ID}>")
+        main.STREAM_RESPONSES = args.stream
+        if args.coalesce_window is not None:
+            main.mention_coalescer.window = args.coalesce_window
+        if args.api_rate:
+            main.SCHEDULER_GUILD_RATE = args.api_rate
+            main.SCHEDULER_GUILD_BURST = max(1, int(args.api_rate))
+            main.request_scheduler = main.RequestScheduler({model: {"rate": args.api_rate, "burst": max(1, int(args.api_rate))} for model in main.SCHEDULER_LANES})
+        result = asyncio.run(drive(main, args, args.users, args.guilds))
+    finally:
+        sys.stdout = real_stdout
+    print(json.dumps(result))
+
+def format_row(memories, result):
+    written = "-" if result["bytes_per_mention"] is None else f"{result['bytes_per_mention']:.0f}"
+    return (f"{memories:>9} {result['startup']:>8.2f} {result['throughput']:>8.1f} {result['p50'] * 1000:>8.0f} {result['p95'] * 1000:>8.0f} {result['p99'] * 1000:>8.0f} "
+            f"{result['loop_lag_p99'] * 1000:>8.1f} {result['loop_lag_max'] * 1000:>8.1f} {result['api_calls_per_mention']:>6.2f} {written:>9} {result['errors']:>6}")
+
+def run_bench(args):
+    port = args.port
+    host = f"http://127.0.0.1:{port}"
+    server_args = [sys.executable, os.path.abspath(__file__), "serve", "--port", str(port), "--latency-ms", str(args.latency_ms), "--jitter", str(args.jitter), "--rate-limit", str(args.rate_limit)]
+    server = subprocess.Popen(server_args)
+    lines = [
+        f"backend={args.backend} model={args.model} stream={args.stream} mentions={args.mentions} concurrency={args.concurrency} guilds={args.guilds} "
+        f"latency={args.latency_ms}ms rate_limit={args.rate_limit} api_rate={args.api_rate or 'production'}",
+        f"{'memories':>9} {'start_s':>8} {'ment/s':>8} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} {'lag99_ms':>8} {'lagmax':>8} {'calls':>6} {'bytes':>9} {'errors':>6}",
+    ]
+    print("\n".join(lines), flush=True)
+    try:
+        for _ in range(50):
+            try:
+                server_stats(host)
+                break
+            except OSError:
+                time.sleep(0.1)
+        for memories in args.sizes:
+            workdir = tempfile.mkdtemp(prefix="doharu-bench-")
+            try:
+                users = build_dataset(workdir, memories, args.guilds, args.model, args.backend)
+                child_args = [
+                    sys.executable, os.path.abspath(__file__), "child", "--workdir", workdir, "--host", host,
+                    "--backend", args.backend, "--users", str(users), "--guilds", str(args.guilds),
+                    "--mentions", str(args.mentions), "--concurrency", str(args.concurrency),
+                    "--timeout", str(args.timeout), "--api-rate", str(args.api_rate),
+                ]
+                if args.stream:
+                    child_args.append("--stream")
+                if args.coalesce_window is not None:
+                    child_args += ["--coalesce-window", str(args.coalesce_window)]
+                output = subprocess.run(child_args, check=True, capture_output=True, text=True).stdout
+                line = format_row(memories, json.loads(output.strip().splitlines()[-1]))
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            lines.append(line)
+            print(line, flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test for the 도하루 mention pipeline against a local HyperCLOVA stand-in.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    server = subparsers.add_parser("serve")
+    server.add_argument("--port", type=int, default=8790)
+    server.add_argument("--latency-ms", type=float, default=300)
+    server.add_argument("--jitter", type=float, default=0.3)
+    server.add_argument("--rate-limit", type=float, default=0.0)
+
+    child = subparsers.add_parser("child")
+    child.add_argument("--workdir", required=True)
+    child.add_argument("--host", required=True)
+    child.add_argument("--backend", default="json")
+    child.add_argument("--users", type=int, required=True)
+    child.add_argument("--guilds", type=int, required=True)
+    child.add_argument("--mentions", type=int, required=True)
+    child.add_argument("--concurrency", type=int, required=True)
+    child.add_argument("--timeout", type=float, required=True)
+    child.add_argument("--api-rate", type=float, default=0)
+    child.add_argument("--stream", action="store_true")
+    child.add_argument("--coalesce-window", type=float)
+
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--model", choices=["HCX-003", "HCX-DASH-001"], default="HCX-DASH-001")
+    parser.add_argument("--mentions", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter", type=float, default=0.3)
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="share of API requests answered with 429")
+    parser.add_argument("--stream", action="store_true", help="use streamed replies; latency is then time to first visible token")
+    parser.add_argument("--coalesce-window", type=float, help="override MENTION_COALESCE_WINDOW")
+    parser.add_argument("--api-rate", type=float, default=1000, help="requests/s per model and guild; 0 keeps the production limits")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--output", default="bench_output.txt")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "serve":
+        serve(args)
+    elif args.command == "child":
+        run_child(args)
+    else:
+        run_bench(args)
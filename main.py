@@ -1,53 +1,1460 @@
-import uuid
+import os
 import aiohttp
+from aiohttp import web
 import discord
 from discord import app_commands
 from discord.ext import commands
 from discord.ui import Button, View
 import asyncio
+import bisect
+import functools
+import gc
+from abc import ABC, abstractmethod
+import hashlib
+import heapq
 import json
-from typing import List, Dict
+import math
+from typing import List, Optional
 import re
-from datetime import datetime, timedelta
+import signal
+import sqlite3
+import sys
+import time
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
 
+STORAGE_BACKEND = os.environ.get("DOHARU_STORAGE_BACKEND", "json")
 DATA_FILE_PATH = "data.json"
+JOURNAL_FILE_PATH = "data.journal"
+SQLITE_DATABASE_PATH = "data.db"
+SQLITE_BUSY_TIMEOUT = 5.0
+COMMAND_TREE_HASH_PATH = "command_tree.hash"
+JOURNAL_COMPACT_THRESHOLD = 5000
+JOURNAL_COMPACT_INTERVAL = 300
+MEMORY_FORMAT_VERSION = 2
+RETRIEVAL_ACCEPT_SCORE = 0.25
+RETRIEVAL_REJECT_SCORE = 0.05
+RETRIEVAL_MARGIN = 0.15
+RETRIEVAL_LLM_CANDIDATES = 3
+LEDGER_SETTLE_INTERVAL = 5.0
+CONVERSATION_TURNS = 3
+CONVERSATION_MAX_ENTRIES = 10000
+CONVERSATION_IDLE_TTL = 3600
+RELEVANCE_CACHE_MAX_ENTRIES = 10000
+RELEVANCE_CACHE_TTL = 600
+MEMORY_VERSION_MAX_ENTRIES = 100000
+MEMORY_TTL = 86400
+EXPIRY_SWEEP_INTERVAL = 60
+EXPIRY_SWEEP_LIMIT = 500
+MEMORY_WORKER_COUNT = 4
+MEMORY_QUEUE_SIZE = 1000
+MEMORY_DRAIN_TIMEOUT = 10
+CONSOLIDATION_INTERVAL = 60
+CONSOLIDATION_WINDOW = 600
+CONSOLIDATION_USERS_PER_RUN = 200
+CONSOLIDATION_CALLS_PER_RUN = 20
+CONSOLIDATION_DUPLICATE_SIMILARITY = 0.8
+CONSOLIDATION_RELATED_SIMILARITY = 0.3
+PERSIST_FLUSH_INTERVAL = 1.0
+PERSIST_MAX_STALENESS = 5.0
+SCHEDULER_LANES = {
+    "HCX-003": {"rate": 1.0, "burst": 5},
+    "HCX-DASH-001": {"rate": 3.0, "burst": 10},
+}
+SCHEDULER_GUILD_RATE = 0.5
+SCHEDULER_GUILD_BURST = 5
+SCHEDULER_GUILD_BUCKET_LIMIT = 10000
+SCHEDULER_MAX_RETRIES = 3
+SCHEDULER_BACKOFF_BASE = 1.0
+SCHEDULER_BACKOFF_MAX = 60.0
+PRIORITY_CHAT = 0
+PRIORITY_BACKGROUND = 1
+BREAKER_WINDOW = 30.0
+BREAKER_MIN_REQUESTS = 10
+BREAKER_ERROR_RATE = 0.5
+# Must stay below every REQUEST_DEADLINES value, or a hung call is cut off before it counts as slow.
+BREAKER_SLOW_CALL = 10.0
+BREAKER_OPEN_DURATION = 30.0
+BREAKER_HALF_OPEN_PROBES = 1
+DEGRADED_NOTICE_INTERVAL = 60.0
+LOOP_LAG_INTERVAL = 0.5
+LOOP_LAG_REPORT_INTERVAL = 300
+ADMIN_USER_IDS = {123456789012345678}
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+SLOW_MENTION_PROFILING = False
+SLOW_MENTION_THRESHOLD = 5.0
+SLOW_MENTION_SAMPLE_INTERVAL = 0.05
+SLOW_MENTION_LOG_PATH = "slow_mentions.log"
+SHARD_COUNT = 4
+SHARD_PROCESSES = 2
+SHARD_RESTART_DELAY = 5
+SHARD_RESTART_MAX_DELAY = 300
+SHARD_HEALTH_INTERVAL = 30
+SHARD_STOP_TIMEOUT = 30
+# Set by the supervisor for its worker processes; a plain `python main.py` runs every shard itself.
+SHARD_IDS = [int(shard_id) for shard_id in os.environ["DOHARU_SHARD_IDS"].split(",")] if os.environ.get("DOHARU_SHARD_IDS") else None
+WORKER_PROCESSES = int(os.environ.get("DOHARU_WORKER_PROCESSES", 1))
+
+class LatencyRecorder:
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentile(self, percent):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def summary(self):
+        if not self.samples:
+            return "no samples"
+        return f"p50={self.percentile(50) * 1000:.1f}ms p99={self.percentile(99) * 1000:.1f}ms max={max(self.samples) * 1000:.1f}ms n={self.count}"
+
+loop_lag = LatencyRecorder()
+first_token_latency = LatencyRecorder()
+process_started = time.monotonic()
+startup_marks = {}
+
+def mark_startup(stage):
+    if stage not in startup_marks:
+        startup_marks[stage] = time.monotonic() - process_started
+        print(f"Startup: {stage} after {startup_marks[stage]:.2f}s")
+
+class Histogram:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation; coarse but allocation free.
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return METRIC_BUCKETS[index] if index < len(METRIC_BUCKETS) else math.inf
+        return math.inf
+
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = Counter()
+        self.gauges = {}
+
+    def observe(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - started)
+
+    def increment(self, name, amount=1, **labels):
+        # Label values are kept as strings so counters with mixed values (200, "error") still sort.
+        self.counters[(name, tuple(sorted((key, str(value)) for key, value in labels.items())))] += amount
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def render(self):
+        # Prometheus text exposition format.
+        lines = []
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f'doharu_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'doharu_stage_seconds_sum{{stage="{stage}"}} {histogram.total}')
+            lines.append(f'doharu_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for (name, labels), value in sorted(self.counters.items()):
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"doharu_{name}{{{label_text}}} {value}" if label_text else f"doharu_{name} {value}")
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"doharu_{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        lines = []
+        for stage, histogram in sorted(self.histograms.items()):
+            lines.append(f"{stage}: p50<={histogram.quantile(0.5) * 1000:.0f}ms p95<={histogram.quantile(0.95) * 1000:.0f}ms p99<={histogram.quantile(0.99) * 1000:.0f}ms n={histogram.count}")
+        for (name, labels), value in sorted(self.counters.items()):
+            label_text = " ".join(f"{key}={label}" for key, label in labels)
+            lines.append(f"{name} {label_text}: {value}" if label_text else f"{name}: {value}")
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"{name}: {read()}")
+        return "\n".join(lines)
+
+metrics = Metrics()
+
+class MemoryRecord:
+    __slots__ = ("id", "server_id", "user_id", "speaker", "memory", "created_at", "n_count")
+
+    def __init__(self, id, server_id, user_id, speaker, memory, created_at, n_count=0):
+        self.id = id
+        self.server_id = server_id
+        self.user_id = user_id
+        self.speaker = speaker
+        self.memory = memory
+        self.created_at = created_at
+        self.n_count = n_count
+
+    def __repr__(self):
+        return f"MemoryRecord(id={self.id}, speaker={self.speaker!r}, memory={self.memory!r}, n_count={self.n_count})"
+
+    def to_row(self):
+        return [self.id, self.server_id, self.user_id, self.speaker, self.memory, self.created_at, self.n_count]
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*row)
+
+    def to_legacy(self):
+        created_at = datetime.fromtimestamp(self.created_at).isoformat()
+        return {
+            "id": str(self.id),
+            "server_id": self.server_id,
+            "user_id": self.user_id,
+            "speaker": self.speaker,
+            "memory": self.memory,
+            "timestamp": created_at,
+            "created_at": created_at,
+            "n_count": self.n_count
+        }
+
+    @classmethod
+    def from_legacy(cls, memory, memory_id):
+        created_at = int(datetime.fromisoformat(memory["created_at"]).timestamp())
+        return cls(memory_id, memory["server_id"], memory["user_id"], memory["speaker"], memory["memory"], created_at, memory["n_count"])
+
+def decode_data(data):
+    # Version 1 is the original list of dicts with uuid ids and ISO timestamps; version 2 stores
+    # one row per memory with integer ids and epoch-second timestamps.
+    version = data.pop("LongTermMemoryVersion", 1)
+    if version == 1:
+        memories = [MemoryRecord.from_legacy(memory, memory_id) for memory_id, memory in enumerate(data["LongTermMemory"], start=1)]
+    else:
+        memories = [MemoryRecord.from_row(row) for row in data["LongTermMemory"]]
+    data["LongTermMemory"] = memories
+    data["NextMemoryId"] = max([data.get("NextMemoryId", 1)] + [memory.id + 1 for memory in memories])
+    return data
+
+def encode_data(data):
+    if MEMORY_FORMAT_VERSION == 1:
+        encoded = {key: value for key, value in data.items() if key != "NextMemoryId"}
+        encoded["LongTermMemory"] = [memory.to_legacy() for memory in data["LongTermMemory"]]
+        return encoded
+    return {**data, "LongTermMemoryVersion": 2, "LongTermMemory": [memory.to_row() for memory in data["LongTermMemory"]]}
+
+def empty_data():
+    return {"ServerTokens": {}, "ServerModels": {}, "ServerEveryoneResponse": {}, "LongTermMemory": []}
+
+def write_file_atomic(path, content):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as file:
+        file.writelines([content] if isinstance(content, str) else content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+def replay_journal(data, paths):
+    # Every journal record is idempotent, so replaying records already folded into the snapshot is harmless.
+    memories = {memory.id: memory for memory in data["LongTermMemory"]}
+    replayed = 0
+    for path in paths:
+        try:
+            file = open(path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            continue
+        with file:
+            for line in file:
+                if not line.endswith("\n"):
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                op = record["op"]
+                if op == "set":
+                    data[record["table"]][record["key"]] = record["value"]
+                elif op == "memory_put":
+                    memory = MemoryRecord.from_row(record["memory"])
+                    memories[memory.id] = memory
+                    data["NextMemoryId"] = max(data["NextMemoryId"], memory.id + 1)
+                elif op == "memory_update":
+                    for memory_id, fields in record["changes"]:
+                        if memory_id in memories:
+                            for field, value in fields.items():
+                                setattr(memories[memory_id], field, value)
+                elif op == "memory_delete":
+                    for memory_id in record["ids"]:
+                        memories.pop(memory_id, None)
+                replayed += 1
+    data["LongTermMemory"] = list(memories.values())
+    return replayed
 
 def read_data():
     try:
         with open(DATA_FILE_PATH, "r", encoding="utf-8") as file:
-            return json.load(file)
+            data = json.load(file)
     except FileNotFoundError:
-        return {"ServerTokens": {}, "ServerModels": {}, "ServerEveryoneResponse": {}, "LongTermMemory": []}
+        data = empty_data()
+    decode_data(data)
+    journal_paths = [JOURNAL_FILE_PATH + ".old", JOURNAL_FILE_PATH]
+    if replay_journal(data, journal_paths) > 0:
+        write_data(data)
+    for path in journal_paths:
+        if os.path.exists(path):
+            os.remove(path)
+    return data
 
 def write_data(data):
-    with open(DATA_FILE_PATH, "w", encoding="utf-8") as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
+    write_file_atomic(DATA_FILE_PATH, serialize_data(encode_data(data)))
+
+def serialize_data(encoded):
+    # The legacy layout stays human-readable; version 2 snapshots are written compactly.
+    return json.dumps(encoded, ensure_ascii=False, indent=4 if MEMORY_FORMAT_VERSION == 1 else None)
+
+def serialize_data_chunks(encoded):
+    # Same text as serialize_data, in pieces. json.dumps' C encoder (or joining one huge string)
+    # holds the GIL for the whole document; writing these pieces from a thread does not.
+    return json.JSONEncoder(ensure_ascii=False, indent=4 if MEMORY_FORMAT_VERSION == 1 else None).iterencode(encoded)
+
+class DataJournal:
+    def __init__(self, path):
+        self.path = path
+        self.old_path = path + ".old"
+        self.file = None
+        self.records = 0
+        self.pending = []
+        self.pending_since = None
+        self.last_flush = 0.0
+        self.dirty = asyncio.Event()
+        self.lock = asyncio.Lock()
+
+    def append(self, record):
+        if not self.pending:
+            self.pending_since = time.monotonic()
+        self.pending.append(json.dumps(record, ensure_ascii=False) + "\n")
+        self.records += 1
+        self.dirty.set()
+
+    def write_lines(self, lines):
+        if self.file is None:
+            self.file = open(self.path, "a", encoding="utf-8")
+        self.file.write("".join(lines))
+        self.file.flush()
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending:
+                return
+            lines = self.pending
+            self.pending = []
+            self.pending_since = None
+            self.dirty.clear()
+            try:
+                with metrics.time("persistence_flush"):
+                    await asyncio.to_thread(self.write_lines, lines)
+            except Exception:
+                self.pending = lines + self.pending
+                self.pending_since = time.monotonic()
+                self.dirty.set()
+                raise
+            self.last_flush = time.monotonic()
+
+    async def run_flusher(self):
+        while True:
+            await self.dirty.wait()
+            delay = min(self.last_flush + PERSIST_FLUSH_INTERVAL, self.pending_since + PERSIST_MAX_STALENESS) - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing journal: {e}")
+                await asyncio.sleep(PERSIST_FLUSH_INTERVAL)
+
+    async def close(self):
+        await self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if not os.path.exists(self.path):
+            return
+        if os.path.exists(self.old_path):
+            # A previous compaction failed before removing the old journal; keep the records in order.
+            with open(self.path, "r", encoding="utf-8") as source, open(self.old_path, "a", encoding="utf-8") as target:
+                target.write(source.read())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.old_path)
+
+    async def compact(self, snapshot):
+        async with self.lock:
+            self.rotate()
+            self.records = len(self.pending)
+            data = snapshot()
+        # Only the cheap copy is taken on the loop. Memories changed while the thread encodes
+        # may be written in either state; their journal records replay over the snapshot.
+        with metrics.time("persistence_snapshot"):
+            encoded = await asyncio.to_thread(encode_data, data)
+        with metrics.time("persistence_compaction"):
+            await asyncio.to_thread(write_file_atomic, DATA_FILE_PATH, serialize_data_chunks(encoded))
+        if os.path.exists(self.old_path):
+            os.remove(self.old_path)
+
+async def monitor_event_loop_lag():
+    loop = asyncio.get_running_loop()
+    last_report = loop.time()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag.record(max(0.0, loop.time() - started - LOOP_LAG_INTERVAL))
+        if loop.time() - last_report >= LOOP_LAG_REPORT_INTERVAL:
+            print(f"Event loop lag: {loop_lag.summary()}")
+            print(f"Time to first visible token: {first_token_latency.summary()}")
+            print(f"Memory maintenance: {memory_workers.summary()}")
+            print(f"Memory consolidation: {memory_consolidator.summary()}")
+            print(f"Request scheduler: {request_scheduler.summary()}")
+            print(f"Hedged requests: {hedge_summary()}")
+            for breaker in circuit_breakers.values():
+                print(f"Circuit breaker {breaker.model}: {breaker.summary()}")
+            print(f"Conversation cache: {conversation_cache.summary()}")
+            print(f"Relevance cache: {relevance_cache.summary()}")
+            print(f"Mention coalescing: {mention_coalescer.summary()}")
+            print(f"Memory expiry: pending={await storage.pending_expiry()} overdue={await storage.overdue_expiry(time.time())}")
+            last_report = loop.time()
+
+class LongTermMemoryStore:
+    def __init__(self, memories=(), next_id=1):
+        self.by_id = {}
+        self.by_user = {}
+        self.next_id = next_id
+        for memory in memories:
+            self.add(memory)
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def allocate_id(self):
+        memory_id = self.next_id
+        self.next_id += 1
+        return memory_id
+
+    def add(self, memory):
+        self.by_id[memory.id] = memory
+        self.by_user.setdefault((memory.server_id, memory.user_id), {})[memory.id] = memory
+        self.next_id = max(self.next_id, memory.id + 1)
+
+    def get(self, memory_id):
+        return self.by_id.get(memory_id)
+
+    def for_user(self, server_id, user_id):
+        return list(self.by_user.get((server_id, user_id), {}).values())
+
+    def delete(self, memory_ids):
+        deleted = []
+        for memory_id in memory_ids:
+            memory = self.by_id.pop(memory_id, None)
+            if memory is None:
+                continue
+            key = (memory.server_id, memory.user_id)
+            bucket = self.by_user[key]
+            del bucket[memory_id]
+            if not bucket:
+                del self.by_user[key]
+            deleted.append(memory)
+        return deleted
+
+    def increment(self, memory_ids, field="n_count"):
+        changes = []
+        for memory_id in memory_ids:
+            memory = self.by_id.get(memory_id)
+            if memory is not None:
+                setattr(memory, field, getattr(memory, field) + 1)
+                changes.append([memory_id, {field: getattr(memory, field)}])
+        return changes
+
+    def to_list(self):
+        return list(self.by_id.values())
+
+class MemoryRetrievalIndex:
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_terms = {}
+        self.document_frequency = Counter()
+        self.total_length = 0
+
+    @staticmethod
+    def tokenize(text):
+        grams = Counter()
+        for word in re.findall(r'\w+', text.lower()):
+            if len(word) == 1:
+                grams[word] += 1
+            for i in range(len(word) - 1):
+                grams[word[i:i + 2]] += 1
+        return grams
+
+    def add(self, memory):
+        self.remove(memory.id)
+        terms = self.tokenize(memory.memory)
+        self.doc_terms[memory.id] = terms
+        self.document_frequency.update(terms.keys())
+        self.total_length += sum(terms.values())
+
+    def remove(self, memory_id):
+        terms = self.doc_terms.pop(memory_id, None)
+        if terms is None:
+            return
+        self.document_frequency.subtract(terms.keys())
+        for term in terms:
+            if self.document_frequency[term] <= 0:
+                del self.document_frequency[term]
+        self.total_length -= sum(terms.values())
+
+    def idf(self, term):
+        document_count = len(self.doc_terms)
+        frequency = self.document_frequency.get(term, 0)
+        return math.log(1 + (document_count - frequency + 0.5) / (frequency + 0.5))
+
+    def rank(self, question, memories):
+        # Returns (coverage, memory) pairs, best first. Coverage is the idf-weighted share of
+        # the question's n-grams found in the memory, so it is comparable across questions.
+        for memory in memories:
+            if memory.id not in self.doc_terms:
+                self.add(memory)
+        weights = {term: self.idf(term) for term in self.tokenize(question)}
+        total_weight = sum(weights.values())
+        average_length = self.total_length / len(self.doc_terms) if self.doc_terms else 1.0
+        ranked = []
+        for memory in memories:
+            terms = self.doc_terms[memory.id]
+            length = sum(terms.values())
+            matched = 0.0
+            bm25 = 0.0
+            for term, weight in weights.items():
+                frequency = terms.get(term, 0)
+                if frequency:
+                    matched += weight
+                    bm25 += weight * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length / average_length))
+            ranked.append((matched / total_weight if total_weight else 0.0, bm25, memory))
+        ranked.sort(key=lambda item: (item[0], item[1]), reverse=True)
+        return [(coverage, memory) for coverage, bm25, memory in ranked]
+
+class MemoryExpiryQueue:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.heap = []
+        self.live = set()
+
+    def push(self, memory):
+        expires_at = memory.created_at + self.ttl
+        heapq.heappush(self.heap, (expires_at, memory.id))
+        self.live.add(memory.id)
+
+    def extend(self, memories):
+        for memory in memories:
+            self.heap.append((memory.created_at + self.ttl, memory.id))
+            self.live.add(memory.id)
+        heapq.heapify(self.heap)
+
+    def discard(self, memory_id):
+        # The heap entry stays behind and is skipped when it is popped.
+        self.live.discard(memory_id)
+        if len(self.heap) > 2 * len(self.live) + 1000:
+            self.heap = [entry for entry in self.heap if entry[1] in self.live]
+            heapq.heapify(self.heap)
+
+    def pop_expired(self, now, limit):
+        expired_ids = []
+        while self.heap and self.heap[0][0] <= now and len(expired_ids) < limit:
+            memory_id = heapq.heappop(self.heap)[1]
+            if memory_id in self.live:
+                self.live.remove(memory_id)
+                expired_ids.append(memory_id)
+        return expired_ids
+
+    def overdue(self, now):
+        count = 0
+        stack = [0] if self.heap else []
+        while stack:
+            index = stack.pop()
+            if self.heap[index][0] > now:
+                continue
+            if self.heap[index][1] in self.live:
+                count += 1
+            stack.extend(child for child in (2 * index + 1, 2 * index + 2) if child < len(self.heap))
+        return count
+
+    def pending(self):
+        return len(self.live)
+
+class StorageBackend(ABC):
+    # Every call is a coroutine so backends that do I/O can keep it off the event loop.
+    @abstractmethod
+    async def get_server_model(self, server_id):
+        pass
+
+    @abstractmethod
+    async def set_server_model(self, server_id, model):
+        pass
+
+    @abstractmethod
+    async def get_everyone_response(self, server_id):
+        pass
+
+    @abstractmethod
+    async def set_everyone_response(self, server_id, everyone_response):
+        pass
+
+    @abstractmethod
+    async def get_server_tokens(self, server_id):
+        pass
+
+    @abstractmethod
+    async def create_server_tokens(self, server_id, tokens):
+        pass
+
+    @abstractmethod
+    async def add_server_tokens(self, server_id, delta):
+        pass
+
+    @abstractmethod
+    async def add_memory(self, server_id, user_id, speaker, memory, created_at):
+        pass
+
+    @abstractmethod
+    async def get_memories(self, server_id, user_id):
+        pass
+
+    @abstractmethod
+    async def delete_memories(self, memory_ids):
+        pass
+
+    @abstractmethod
+    async def increment_memory_counts(self, memory_ids):
+        pass
+
+    @abstractmethod
+    async def expire_memories(self, now, limit):
+        pass
+
+    @abstractmethod
+    async def pending_expiry(self):
+        pass
+
+    @abstractmethod
+    async def overdue_expiry(self, now):
+        pass
+
+    async def record_shard_health(self, rows):
+        pass
+
+    async def get_shard_health(self):
+        return []
+
+    def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+class JsonStorage(StorageBackend):
+    def __init__(self):
+        self.data = read_data()
+        self.memory_store = LongTermMemoryStore(self.data.pop("LongTermMemory"), self.data.pop("NextMemoryId"))
+        self.expiry_queue = MemoryExpiryQueue(MEMORY_TTL)
+        self.expiry_queue.extend(self.memory_store)
+        self.journal = DataJournal(JOURNAL_FILE_PATH)
+
+    def set_value(self, table, key, value):
+        self.data[table][key] = value
+        self.journal.append({"op": "set", "table": table, "key": key, "value": value})
+
+    def snapshot(self):
+        # Copies the containers, not the records, so it is cheap enough to take on the loop.
+        tables = {table: dict(values) if isinstance(values, dict) else values for table, values in self.data.items()}
+        return {**tables, "LongTermMemory": self.memory_store.to_list(), "NextMemoryId": self.memory_store.next_id}
+
+    async def get_server_model(self, server_id):
+        return self.data["ServerModels"].get(str(server_id))
+
+    async def set_server_model(self, server_id, model):
+        self.set_value("ServerModels", str(server_id), model)
+
+    async def get_everyone_response(self, server_id):
+        return self.data["ServerEveryoneResponse"].get(str(server_id))
+
+    async def set_everyone_response(self, server_id, everyone_response):
+        self.set_value("ServerEveryoneResponse", str(server_id), everyone_response)
+
+    async def get_server_tokens(self, server_id):
+        return self.data["ServerTokens"].get(str(server_id))
+
+    async def create_server_tokens(self, server_id, tokens):
+        entry = await self.get_server_tokens(server_id)
+        if entry is None:
+            entry = {"tokens": tokens, "gived": True}
+            self.set_value("ServerTokens", str(server_id), entry)
+        return entry
+
+    async def add_server_tokens(self, server_id, delta):
+        entry = await self.get_server_tokens(server_id)
+        if entry is None:
+            entry = {"tokens": delta, "gived": True}
+        else:
+            entry = {**entry, "tokens": entry["tokens"] + delta}
+        self.set_value("ServerTokens", str(server_id), entry)
+        return entry
+
+    async def add_memory(self, server_id, user_id, speaker, memory, created_at):
+        record = MemoryRecord(self.memory_store.allocate_id(), server_id, user_id, speaker, memory, created_at)
+        self.memory_store.add(record)
+        self.expiry_queue.push(record)
+        self.journal.append({"op": "memory_put", "memory": record.to_row()})
+        return record
+
+    async def get_memories(self, server_id, user_id):
+        return self.memory_store.for_user(server_id, user_id)
+
+    async def delete_memories(self, memory_ids):
+        deleted = self.memory_store.delete(memory_ids)
+        for memory in deleted:
+            self.expiry_queue.discard(memory.id)
+        if deleted:
+            self.journal.append({"op": "memory_delete", "ids": [memory.id for memory in deleted]})
+        return deleted
+
+    async def increment_memory_counts(self, memory_ids):
+        changes = self.memory_store.increment(memory_ids)
+        if changes:
+            self.journal.append({"op": "memory_update", "changes": changes})
+        return {(self.memory_store.by_id[memory_id].server_id, self.memory_store.by_id[memory_id].user_id) for memory_id, _ in changes}
+
+    async def expire_memories(self, now, limit):
+        return await self.delete_memories(self.expiry_queue.pop_expired(now, limit))
+
+    async def pending_expiry(self):
+        return self.expiry_queue.pending()
+
+    async def overdue_expiry(self, now):
+        return self.expiry_queue.overdue(now)
+
+    def start(self):
+        asyncio.create_task(self.journal.run_flusher())
+        asyncio.create_task(self.run_compaction())
+
+    async def run_compaction(self):
+        while True:
+            await asyncio.sleep(JOURNAL_COMPACT_INTERVAL)
+            if self.journal.records >= JOURNAL_COMPACT_THRESHOLD:
+                try:
+                    await self.journal.compact(self.snapshot)
+                except Exception as e:
+                    print(f"Error compacting journal: {e}")
+
+    async def close(self):
+        await self.journal.close()
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS server_settings (
+    server_id TEXT PRIMARY KEY,
+    model TEXT,
+    everyone_response INTEGER
+);
+CREATE TABLE IF NOT EXISTS server_tokens (
+    server_id TEXT PRIMARY KEY,
+    tokens INTEGER NOT NULL,
+    gived INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS long_term_memory (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    server_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    speaker TEXT NOT NULL,
+    memory TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    n_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS long_term_memory_user ON long_term_memory (server_id, user_id);
+CREATE INDEX IF NOT EXISTS long_term_memory_created_at ON long_term_memory (created_at);
+CREATE TABLE IF NOT EXISTS shard_health (
+    shard_id INTEGER PRIMARY KEY,
+    pid INTEGER NOT NULL,
+    latency REAL,
+    guilds INTEGER NOT NULL,
+    closed INTEGER NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+SQLITE_MEMORY_COLUMNS = "id, server_id, user_id, speaker, memory, created_at, n_count"
+
+def on_connection_thread(method):
+    @functools.wraps(method)
+    async def call(self, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, self, *args)
+    return call
+
+class SQLiteStorage(StorageBackend):
+    def __init__(self, path, shard_ids=None, shard_count=None):
+        # Queries run on one thread that owns the connection. Sharded workers share the WAL
+        # writer lock, so a busy wait or a checkpoint stalls that thread, not the event loop.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.connection = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SQLITE_SCHEMA)
+        # Background sweeps only touch guilds on this process's shards, matching Discord's
+        # (guild_id >> 22) % shard_count assignment, so workers never race each other.
+        if shard_ids is None:
+            self.owned = "1"
+        else:
+            self.owned = f"((server_id >> 22) % {int(shard_count)}) IN ({', '.join(str(int(shard_id)) for shard_id in shard_ids)})"
+
+    @on_connection_thread
+    def get_server_model(self, server_id):
+        row = self.connection.execute("SELECT model FROM server_settings WHERE server_id = ?", (str(server_id),)).fetchone()
+        return row[0] if row else None
+
+    @on_connection_thread
+    def set_server_model(self, server_id, model):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO server_settings (server_id, model) VALUES (?, ?) "
+                "ON CONFLICT (server_id) DO UPDATE SET model = excluded.model",
+                (str(server_id), model))
+
+    @on_connection_thread
+    def get_everyone_response(self, server_id):
+        row = self.connection.execute("SELECT everyone_response FROM server_settings WHERE server_id = ?", (str(server_id),)).fetchone()
+        return bool(row[0]) if row and row[0] is not None else None
+
+    @on_connection_thread
+    def set_everyone_response(self, server_id, everyone_response):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO server_settings (server_id, everyone_response) VALUES (?, ?) "
+                "ON CONFLICT (server_id) DO UPDATE SET everyone_response = excluded.everyone_response",
+                (str(server_id), int(everyone_response)))
+
+    def read_server_tokens(self, server_id):
+        row = self.connection.execute("SELECT tokens, gived FROM server_tokens WHERE server_id = ?", (str(server_id),)).fetchone()
+        return {"tokens": row[0], "gived": bool(row[1])} if row else None
+
+    @on_connection_thread
+    def get_server_tokens(self, server_id):
+        return self.read_server_tokens(server_id)
+
+    @on_connection_thread
+    def create_server_tokens(self, server_id, tokens):
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO server_tokens (server_id, tokens, gived) VALUES (?, ?, 1)", (str(server_id), tokens))
+        return self.read_server_tokens(server_id)
+
+    @on_connection_thread
+    def add_server_tokens(self, server_id, delta):
+        with self.connection:
+            self.connection.execute(
+                "INSERT INTO server_tokens (server_id, tokens, gived) VALUES (?, ?, 1) "
+                "ON CONFLICT (server_id) DO UPDATE SET tokens = tokens + excluded.tokens",
+                (str(server_id), delta))
+        return self.read_server_tokens(server_id)
+
+    @on_connection_thread
+    def add_memory(self, server_id, user_id, speaker, memory, created_at):
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO long_term_memory (server_id, user_id, speaker, memory, created_at) VALUES (?, ?, ?, ?, ?)",
+                (server_id, user_id, speaker, memory, created_at))
+        return MemoryRecord(cursor.lastrowid, server_id, user_id, speaker, memory, created_at)
+
+    @on_connection_thread
+    def get_memories(self, server_id, user_id):
+        rows = self.connection.execute(
+            f"SELECT {SQLITE_MEMORY_COLUMNS} FROM long_term_memory WHERE server_id = ? AND user_id = ? ORDER BY id",
+            (server_id, user_id))
+        return [MemoryRecord.from_row(row) for row in rows]
+
+    def remove_memories(self, memory_ids):
+        memory_ids = list(memory_ids)
+        if not memory_ids:
+            return []
+        placeholders = ", ".join("?" * len(memory_ids))
+        with self.connection:
+            rows = self.connection.execute(f"SELECT {SQLITE_MEMORY_COLUMNS} FROM long_term_memory WHERE id IN ({placeholders})", memory_ids).fetchall()
+            self.connection.execute(f"DELETE FROM long_term_memory WHERE id IN ({placeholders})", memory_ids)
+        return [MemoryRecord.from_row(row) for row in rows]
+
+    @on_connection_thread
+    def delete_memories(self, memory_ids):
+        return self.remove_memories(memory_ids)
+
+    @on_connection_thread
+    def increment_memory_counts(self, memory_ids):
+        memory_ids = list(memory_ids)
+        if not memory_ids:
+            return set()
+        placeholders = ", ".join("?" * len(memory_ids))
+        with self.connection:
+            self.connection.executemany("UPDATE long_term_memory SET n_count = n_count + 1 WHERE id = ?", [(memory_id,) for memory_id in memory_ids])
+            owners = self.connection.execute(f"SELECT DISTINCT server_id, user_id FROM long_term_memory WHERE id IN ({placeholders})", memory_ids).fetchall()
+        return set(owners)
+
+    @on_connection_thread
+    def expire_memories(self, now, limit):
+        rows = self.connection.execute(
+            f"SELECT id FROM long_term_memory WHERE created_at <= ? AND {self.owned} ORDER BY created_at LIMIT ?",
+            (int(now - MEMORY_TTL), limit)).fetchall()
+        return self.remove_memories([row[0] for row in rows])
+
+    @on_connection_thread
+    def pending_expiry(self):
+        return self.connection.execute(f"SELECT COUNT(*) FROM long_term_memory WHERE {self.owned}").fetchone()[0]
+
+    @on_connection_thread
+    def overdue_expiry(self, now):
+        return self.connection.execute(f"SELECT COUNT(*) FROM long_term_memory WHERE created_at <= ? AND {self.owned}", (int(now - MEMORY_TTL),)).fetchone()[0]
+
+    @on_connection_thread
+    def record_shard_health(self, rows):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO shard_health (shard_id, pid, latency, guilds, closed, updated_at) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    @on_connection_thread
+    def get_shard_health(self):
+        return self.connection.execute("SELECT shard_id, pid, latency, guilds, closed, updated_at FROM shard_health ORDER BY shard_id").fetchall()
+
+    @on_connection_thread
+    def close_connection(self):
+        self.connection.close()
+
+    async def close(self):
+        await self.close_connection()
+        self.executor.shutdown()
+
+def migrate_json_to_sqlite(sqlite_path):
+    source = read_data()
+    target = SQLiteStorage(sqlite_path)
+    existing = target.connection.execute("SELECT (SELECT COUNT(*) FROM long_term_memory) + (SELECT COUNT(*) FROM server_tokens) + (SELECT COUNT(*) FROM server_settings)").fetchone()[0]
+    if existing:
+        print(f"{sqlite_path} already has data, not migrating")
+        return
+    server_ids = set(source["ServerModels"]) | set(source["ServerEveryoneResponse"])
+    with target.connection:
+        target.connection.executemany(
+            "INSERT INTO server_settings (server_id, model, everyone_response) VALUES (?, ?, ?)",
+            [(server_id, source["ServerModels"].get(server_id), source["ServerEveryoneResponse"].get(server_id)) for server_id in server_ids])
+        target.connection.executemany(
+            "INSERT INTO server_tokens (server_id, tokens, gived) VALUES (?, ?, ?)",
+            [(server_id, entry["tokens"], int(entry["gived"])) for server_id, entry in source["ServerTokens"].items()])
+        target.connection.executemany(
+            f"INSERT INTO long_term_memory ({SQLITE_MEMORY_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [memory.to_row() for memory in source["LongTermMemory"]])
+        target.connection.execute("DELETE FROM sqlite_sequence WHERE name = 'long_term_memory'")
+        target.connection.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('long_term_memory', ?)", (source["NextMemoryId"] - 1,))
+    target.connection.close()
+    print(f"Migrated {len(server_ids)} server settings, {len(source['ServerTokens'])} token balances and {len(source['LongTermMemory'])} memories to {sqlite_path}")
+
+def create_storage():
+    if STORAGE_BACKEND == "sqlite":
+        return SQLiteStorage(SQLITE_DATABASE_PATH, SHARD_IDS, SHARD_COUNT)
+    if SHARD_IDS is not None:
+        raise RuntimeError("Sharded workers need STORAGE_BACKEND = \"sqlite\" to share state")
+    return JsonStorage()
+
+storage = create_storage()
+# The loaded data lives as long as the process. Freezing it keeps full GC passes (for example
+# ones set off by a compaction's allocations) from walking every memory while holding the GIL.
+gc.freeze()
+# Memories are indexed the first time their user is ranked, not at startup.
+retrieval_index = MemoryRetrievalIndex()
+mark_startup("storage loaded")
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class SchedulerLane:
+    def __init__(self, model, rate, burst):
+        self.model = model
+        self.bucket = TokenBucket(rate, burst)
+        self.guild_buckets = {}
+        # One round-robin ring of guild queues per priority, lowest number first.
+        self.waiting = [OrderedDict() for _ in (PRIORITY_CHAT, PRIORITY_BACKGROUND)]
+        self.wakeup = asyncio.Event()
+        self.backoff_until = 0.0
+        self.backoff_failures = 0
+        self.throttled = 0
+        self.wait_times = LatencyRecorder()
+        self.task = None
+
+    def depth(self):
+        return sum(len(queue) for waiting in self.waiting for queue in waiting.values())
+
+    def guild_bucket(self, guild_id):
+        bucket = self.guild_buckets.get(guild_id)
+        if bucket is None:
+            if len(self.guild_buckets) >= SCHEDULER_GUILD_BUCKET_LIMIT:
+                now = time.monotonic()
+                for idle_guild_id in [key for key, idle in self.guild_buckets.items() if idle.delay(now) == 0 and idle.tokens >= idle.burst]:
+                    del self.guild_buckets[idle_guild_id]
+            bucket = self.guild_buckets[guild_id] = TokenBucket(SCHEDULER_GUILD_RATE, SCHEDULER_GUILD_BURST)
+        return bucket
+
+    async def acquire(self, guild_id, priority):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[priority].setdefault(guild_id, deque()).append((future, time.monotonic()))
+        self.wakeup.set()
+        await future
+
+    def select(self, now):
+        soonest = None
+        for waiting in self.waiting:
+            for guild_id, queue in list(waiting.items()):
+                while queue and queue[0][0].done():
+                    queue.popleft()
+                if not queue:
+                    del waiting[guild_id]
+                    continue
+                delay = self.guild_bucket(guild_id).delay(now)
+                if delay <= 0:
+                    return waiting, guild_id, 0.0
+                soonest = delay if soonest is None else min(soonest, delay)
+        return None, None, soonest
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            delay = max(self.backoff_until - now, self.bucket.delay(now))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            waiting, guild_id, delay = self.select(now)
+            if waiting is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            future, enqueued = waiting[guild_id].popleft()
+            if waiting[guild_id]:
+                waiting.move_to_end(guild_id)
+            else:
+                del waiting[guild_id]
+            self.bucket.take()
+            self.guild_bucket(guild_id).take()
+            self.wait_times.record(now - enqueued)
+            future.set_result(None)
+
+    def report_throttled(self, retry_after):
+        self.throttled += 1
+        self.backoff_failures += 1
+        delay = min(SCHEDULER_BACKOFF_MAX, SCHEDULER_BACKOFF_BASE * 2 ** (self.backoff_failures - 1))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        self.backoff_until = max(self.backoff_until, time.monotonic() + delay)
+        print(f"{self.model} throttled (429), backing off for {delay:.1f}s")
+
+    def report_success(self):
+        self.backoff_failures = 0
+
+    def summary(self):
+        backoff = max(0.0, self.backoff_until - time.monotonic())
+        return f"{self.model}: depth={self.depth()} wait {self.wait_times.summary()} throttled={self.throttled} backoff={backoff:.1f}s"
+
+class RequestScheduler:
+    def __init__(self, lanes, processes=1):
+        # Each worker process gets an equal share of the global API quota.
+        self.lanes = {model: SchedulerLane(model, lane["rate"] / processes, max(1, lane["burst"] // processes)) for model, lane in lanes.items()}
+
+    async def acquire(self, model, guild_id, priority):
+        await self.lanes[model].acquire(guild_id, priority)
+
+    def report_throttled(self, model, retry_after):
+        try:
+            retry_after = float(retry_after) if retry_after is not None else None
+        except ValueError:
+            retry_after = None
+        self.lanes[model].report_throttled(retry_after)
+
+    def report_success(self, model):
+        self.lanes[model].report_success()
+
+    def summary(self):
+        return "; ".join(lane.summary() for lane in self.lanes.values())
+
+request_scheduler = RequestScheduler(SCHEDULER_LANES, WORKER_PROCESSES)
+metrics.gauge("scheduler_waiting", lambda: sum(lane.depth() for lane in request_scheduler.lanes.values()))
+
+class CircuitOpenError(Exception):
+    pass
+
+# Cancellation message used when a request runs out of its deadline.
+DEADLINE_CANCEL = "deadline"
+
+class CircuitBreaker:
+    # Opens when, over the last BREAKER_WINDOW seconds, enough calls failed or took longer
+    # than BREAKER_SLOW_CALL. After BREAKER_OPEN_DURATION it lets a few probe calls through
+    # (half-open) and closes again on the first successful probe.
+    def __init__(self, model):
+        self.model = model
+        self.state = "closed"
+        self.outcomes = deque()
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = 0
+        self.transitions = deque(maxlen=20)
+
+    def transition(self, state, reason):
+        print(f"Circuit breaker {self.model}: {self.state} -> {state} ({reason})")
+        metrics.increment("breaker_transitions", model=self.model, state=state)
+        self.transitions.append((datetime.now().isoformat(timespec="seconds"), self.state, state, reason))
+        self.state = state
+        if state == "open":
+            self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        self.failures = 0
+        self.probing = 0
+
+    def available(self):
+        if self.state == "open" and time.monotonic() - self.opened_at >= BREAKER_OPEN_DURATION:
+            self.transition("half_open", "probing")
+        return self.state == "closed" or (self.state == "half_open" and self.probing < BREAKER_HALF_OPEN_PROBES)
+
+    def allow(self):
+        if not self.available():
+            return False
+        if self.state == "half_open":
+            self.probing += 1
+        return True
+
+    def release(self):
+        if self.state == "half_open" and self.probing:
+            self.probing -= 1
+
+    def cancelled(self, seconds, error):
+        # A call cut off by its deadline, or after running slow, is the hung API this breaker
+        # is for. Only a hedge loser cancelled early says nothing about the service.
+        if seconds >= BREAKER_SLOW_CALL or DEADLINE_CANCEL in error.args:
+            self.record(seconds, True)
+        else:
+            self.release()
+
+    def record(self, seconds, failed):
+        failed = failed or seconds >= BREAKER_SLOW_CALL
+        if self.state == "half_open":
+            self.probing = max(0, self.probing - 1)
+            if failed:
+                self.transition("open", "probe failed")
+            else:
+                self.transition("closed", "probe succeeded")
+            return
+        if self.state != "closed":
+            return
+        now = time.monotonic()
+        self.outcomes.append((now, failed))
+        self.failures += failed
+        while self.outcomes and now - self.outcomes[0][0] > BREAKER_WINDOW:
+            self.failures -= self.outcomes.popleft()[1]
+        if len(self.outcomes) >= BREAKER_MIN_REQUESTS and self.failures / len(self.outcomes) >= BREAKER_ERROR_RATE:
+            self.transition("open", f"{self.failures}/{len(self.outcomes)} calls failed or slow")
+
+    def summary(self):
+        last = " ".join(self.transitions[-1]) if self.transitions else "none"
+        return f"state={self.state} window={len(self.outcomes)} failures={self.failures} last_transition={last}"
+
+BREAKER_STATES = {"closed": 0, "half_open": 1, "open": 2}
+circuit_breakers = {model: CircuitBreaker(model) for model in SCHEDULER_LANES}
+for model, breaker in circuit_breakers.items():
+    metrics.gauge(f'breaker_state{{model="{model}"}}', lambda breaker=breaker: BREAKER_STATES[breaker.state])
 
-data = read_data()
+class ChatResponse:
+    def __init__(self, http_status, body, rejected=False):
+        self.http_status = http_status
+        self.body = body
+        # Set when the circuit breaker refused the call without contacting the API.
+        self.rejected = rejected
+
+    @property
+    def status_code(self):
+        return self.body['status']['code'] if self.body else None
+
+    @property
+    def content(self):
+        return self.body['result']['message']['content']
 
 class CompletionExecutor:
     def __init__(self, host, request_id):
         self._host = host
         self._request_id = request_id
-        self.headers = {
+        self.model_headers = {}
+        self.session = None
+
+    def set_api_key(self, model, api_key, api_key_primary_val):
+        self.model_headers[model] = {
             'X-NCP-CLOVASTUDIO-REQUEST-ID': self._request_id,
             'Content-Type': 'application/json; charset=utf-8',
+            'X-NCP-CLOVASTUDIO-API-KEY': api_key,
+            'X-NCP-APIGW-API-KEY': api_key_primary_val,
         }
 
-    def set_api_key(self, api_key, api_key_primary_val):
-        self.headers['X-NCP-CLOVASTUDIO-API-KEY'] = api_key
-        self.headers['X-NCP-APIGW-API-KEY'] = api_key_primary_val
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HYPERCLOVA_POOL_SIZE,
+                limit_per_host=HYPERCLOVA_POOL_SIZE,
+                keepalive_timeout=HYPERCLOVA_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HYPERCLOVA_REQUEST_TIMEOUT))
+        return self.session
+
+    async def post(self, model, request_data, headers, guild_id, priority):
+        url = f"{self._host}/serviceapp/v1/chat-completions/{model}"
+        for attempt in range(SCHEDULER_MAX_RETRIES + 1):
+            await request_scheduler.acquire(model, guild_id, priority)
+            breaker = circuit_breakers[model]
+            if not breaker.allow():
+                metrics.increment("api_requests", model=model, status="rejected")
+                raise CircuitOpenError(model)
+            started = time.monotonic()
+            try:
+                response = await self.get_session().post(url, headers=headers, json=request_data)
+            except asyncio.CancelledError as e:
+                breaker.cancelled(time.monotonic() - started, e)
+                raise
+            except Exception:
+                breaker.record(time.monotonic() - started, True)
+                metrics.increment("api_requests", model=model, status="error")
+                raise
+            breaker.record(time.monotonic() - started, response.status >= 500)
+            metrics.increment("api_requests", model=model, status=response.status)
+            if response.status != 429:
+                request_scheduler.report_success(model)
+                return response, started
+            request_scheduler.report_throttled(model, response.headers.get("Retry-After"))
+            if attempt == SCHEDULER_MAX_RETRIES:
+                return response, started
+            response.release()
+
+    async def chat(self, model, messages, *, guild_id=None, priority=PRIORITY_CHAT, **params):
+        request_data = {"messages": messages, **params}
+        try:
+            pending_response, started = await self.post(model, request_data, self.model_headers[model], guild_id, priority)
+        except CircuitOpenError:
+            return ChatResponse(503, None, rejected=True)
+        try:
+            async with pending_response as response:
+                if response.status != 200:
+                    return ChatResponse(response.status, None)
+                return ChatResponse(response.status, await response.json(content_type=None))
+        except asyncio.CancelledError as e:
+            circuit_breakers[model].cancelled(time.monotonic() - started, e)
+            raise
+
+    async def chat_stream(self, model, messages, on_token, *, guild_id=None, priority=PRIORITY_CHAT, **params):
+        headers = {**self.model_headers[model], 'Accept': 'text/event-stream'}
+        request_data = {"messages": messages, **params}
+        try:
+            pending_response, started = await self.post(model, request_data, headers, guild_id, priority)
+        except CircuitOpenError:
+            return ChatResponse(503, None, rejected=True)
+        try:
+            async with pending_response as response:
+                if response.status != 200:
+                    return ChatResponse(response.status, None)
+                content = ""
+                event = None
+                async for raw_line in response.content:
+                    line = raw_line.decode("utf-8").rstrip("\r\n")
+                    if line.startswith("event:"):
+                        event = line[len("event:"):].strip()
+                        continue
+                    if not line.startswith("data:"):
+                        continue
+                    try:
+                        payload = json.loads(line[len("data:"):].strip())
+                    except json.JSONDecodeError:
+                        continue
+                    if event == "token":
+                        delta = payload["message"]["content"]
+                        content += delta
+                        await on_token(delta)
+                    elif event == "result":
+                        content = payload["message"]["content"]
+                    elif event == "error":
+                        return ChatResponse(response.status, {"status": payload["status"]})
+                return ChatResponse(response.status, {"status": {"code": "20000"}, "result": {"message": {"role": "assistant", "content": content}}})
+        except asyncio.CancelledError as e:
+            circuit_breakers[model].cancelled(time.monotonic() - started, e)
+            raise
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.messages = True
 intents.guilds = True
 
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=None)
+class DoharuBot(commands.AutoShardedBot):
+    async def setup_hook(self):
+        storage.start()
+        if SHARD_IDS is not None:
+            self.loop.create_task(self.report_shard_health())
+        self.loop.create_task(expire_old_memories())
+        self.loop.create_task(monitor_event_loop_lag())
+        self.loop.create_task(token_ledger.run_settlement())
+        memory_workers.start()
+        self.loop.create_task(memory_consolidator.run())
+        self.add_dynamic_items(MemoryPageButton, MemoryDeleteSelect)
+        if METRICS_PORT:
+            try:
+                await self.start_metrics_server()
+            except OSError as e:
+                print(f"Error starting metrics server: {e}")
+        # Only one process registers commands when running sharded.
+        if SHARD_IDS is None or 0 in SHARD_IDS:
+            try:
+                if await sync_command_tree(self.tree):
+                    print("Slash commands changed, synced command tree")
+            except Exception as e:
+                print(f"Error syncing command tree: {e}")
+        mark_startup("setup done")
+
+    async def close(self):
+        await super().close()
+        if getattr(self, "metrics_runner", None):
+            await self.metrics_runner.cleanup()
+        await memory_workers.drain(MEMORY_DRAIN_TIMEOUT)
+        await completion_executor.close()
+        await token_ledger.settle()
+        await storage.close()
 
-HYPERCLOVA_API_URL = "https://clovastudio.apigw.ntruss.com/serviceapp/v1/chat-completions/HCX-DASH-001"
-HYPERCLOVA_API_KEY = "YOUR_HYPERCLOVA_API_KEY"
-HYPERCLOVA_API_KEY_PRIMARY_VAL = "YOUR_HYPERCLOVA_API_KEY_PRIMARY_VAL"
+    async def start_metrics_server(self):
+        # Plain-text metrics for a local scraper; each sharded worker listens on its own port.
+        app = web.Application()
+        app.router.add_get("/metrics", lambda request: web.Response(text=metrics.render()))
+        self.metrics_runner = web.AppRunner(app, access_log=None)
+        await self.metrics_runner.setup()
+        port = METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+        await web.TCPSite(self.metrics_runner, METRICS_HOST, port).start()
+        print(f"Metrics on http://{METRICS_HOST}:{port}/metrics")
+
+    async def report_shard_health(self):
+        while True:
+            try:
+                guilds = Counter(guild.shard_id for guild in self.guilds)
+                await storage.record_shard_health([
+                    (shard_id, os.getpid(), shard.latency, guilds[shard_id], shard.is_closed(), time.time())
+                    for shard_id, shard in self.shards.items()
+                ])
+            except Exception as e:
+                print(f"Error reporting shard health: {e}")
+            await asyncio.sleep(SHARD_HEALTH_INTERVAL)
+
+async def sync_command_tree(tree):
+    # Syncing is rate limited and slow, so it only happens when the command definitions
+    # (or the application they belong to) differ from the last successful sync.
+    definitions = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda command: command["name"])
+    payload = json.dumps({"application_id": tree.client.application_id, "commands": definitions}, sort_keys=True, ensure_ascii=False)
+    digest = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+    try:
+        with open(COMMAND_TREE_HASH_PATH, "r", encoding="utf-8") as file:
+            if file.read().strip() == digest:
+                return False
+    except FileNotFoundError:
+        pass
+    await tree.sync()
+    write_file_atomic(COMMAND_TREE_HASH_PATH, digest)
+    return True
+
+bot = DoharuBot(command_prefix="!", intents=intents, help_command=None, shard_ids=SHARD_IDS, shard_count=SHARD_COUNT if SHARD_IDS is not None else None)
+
+HYPERCLOVA_API_KEYS = {
+    "HCX-003": ("YOUR_HYPERCLOVA_API_KEY_FOR_HCX_003", "YOUR_HYPERCLOVA_API_KEY_PRIMARY_VAL"),
+    "HCX-DASH-001": ("YOUR_HYPERCLOVA_API_KEY_FOR_HCX_DASH_001", "YOUR_HYPERCLOVA_API_KEY_PRIMARY_VAL"),
+}
+HYPERCLOVA_HOST = os.environ.get("HYPERCLOVA_HOST", "https://clovastudio.apigw.ntruss.com")
+HYPERCLOVA_POOL_SIZE = 32
+HYPERCLOVA_REQUEST_TIMEOUT = 60
+HYPERCLOVA_KEEPALIVE_TIMEOUT = 60
+MEMORY_MODEL = "HCX-DASH-001"
+STREAM_RESPONSES = False
+STREAM_EDIT_INTERVAL = 1.0
+MODEL_TOKEN_COSTS = {"HCX-003": 10, "HCX-DASH-001": 5}
+LATENCY_SLO_MODE = True
+REQUEST_DEADLINES = {"HCX-003": 30.0, "HCX-DASH-001": 15.0}
+# The relevance call runs before the completion and outside its deadline, so it gets its own.
+RELEVANCE_DEADLINE = 3.0
+# A request still unanswered after its hedge threshold gets a duplicate sent to HEDGE_MODELS[model].
+# The threshold follows the model's observed p95 so only the slowest few requests are duplicated.
+HEDGE_THRESHOLDS = {"HCX-003": 6.0, "HCX-DASH-001": 3.0}
+HEDGE_MODELS = {"HCX-003": "HCX-DASH-001", "HCX-DASH-001": "HCX-DASH-001"}
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 50
+PROMPT_INPUT_BUDGETS = {"HCX-003": 2048, "HCX-DASH-001": 1024}
+PROMPT_QUESTION_MAX_TOKENS = 400
+PROMPT_MEMORY_MAX_TOKENS = 120
+PROMPT_MESSAGE_OVERHEAD = 4
+MENTION_COALESCE_WINDOW = 1.5
+MENTION_COALESCE_MAX_DELAY = 4.0
+MENTION_COALESCE_MAX_MESSAGES = 5
+MENTION_CHANNEL_CONCURRENCY = 2
 
 class ModeSettingPage:
     def __init__(self, on_select_callback, page_number):
@@ -67,8 +1474,8 @@ class ModeSettingPage:
         self.default_mode = "Rapid"
         self.select_menu.callback = on_select_callback
 
-    def update_select_menu(self, server_id):
-        current_mode = get_server_model(server_id)
+    def update_select_menu(self):
+        current_mode = self.view.settings["model"]
         if current_mode:
             for option in self.select_menu.options:
                 if current_mode == "HCX-DASH-001":
@@ -97,8 +1504,9 @@ class ModeSettingPage:
             model_code = "HCX-DASH-001"
         elif selected_mode == "Hyper":
             model_code = "HCX-003"
-        update_server_model(interaction.guild_id, model_code)
-        self.update_select_menu(interaction.guild_id)
+        await update_server_model(interaction.guild_id, model_code)
+        self.view.settings["model"] = model_code
+        self.update_select_menu()
         self.view.update_buttons()
         await interaction.response.edit_message(embed=self.embed, view=self.view)
 
@@ -120,8 +1528,8 @@ class EveryoneResponseSettingPage:
         self.default_everyone_response = "on"
         self.select_menu.callback = on_select_callback
 
-    def update_select_menu(self, server_id):
-        current_everyone_response = get_server_everyone_response(server_id)
+    def update_select_menu(self):
+        current_everyone_response = self.view.settings["everyone_response"]
         if current_everyone_response:
             for option in self.select_menu.options:
                 if option.value == "on":
@@ -140,15 +1548,18 @@ class EveryoneResponseSettingPage:
 
     async def on_select(self, interaction):
         selected_everyone_response = self.select_menu.values[0]
-        update_server_everyone_response(interaction.guild_id, selected_everyone_response == "on")
-        self.update_select_menu(interaction.guild_id)
+        await update_server_everyone_response(interaction.guild_id, selected_everyone_response == "on")
+        self.view.settings["everyone_response"] = selected_everyone_response == "on"
+        self.update_select_menu()
         self.view.update_buttons()
         await interaction.response.edit_message(embed=self.embed, view=self.view)
 
 class SettingsView(discord.ui.View):
-    def __init__(self, server_id):
+    def __init__(self, server_id, settings):
         super().__init__(timeout=300)
         self.server_id = server_id
+        # Current values, read once by the command so the pages can render without awaiting storage.
+        self.settings = settings
         self.pages = [
             ModeSettingPage(self.on_select, page_number=0), 
             EveryoneResponseSettingPage(self.on_select, page_number=1)
@@ -165,7 +1576,7 @@ class SettingsView(discord.ui.View):
     def update_buttons(self):
         self.clear_items()
         current_page = self.pages[self.current_page_index]
-        current_page.update_select_menu(self.server_id)
+        current_page.update_select_menu()
         self.add_item(current_page.select_menu)
         if self.current_page_index > 0:
             self.add_item(self.left_button)
@@ -190,117 +1601,477 @@ class SettingsView(discord.ui.View):
         self.update_buttons()
         await interaction.message.edit(embed=self.pages[self.current_page_index].embed, view=self)
 
-class ChatMemory:
-    def __init__(self):
-        self.user_memories = {}
+class ConversationTurn:
+    __slots__ = ("user_input", "bot_response")
+
+    def __init__(self, user_input, bot_response):
+        self.user_input = user_input
+        self.bot_response = bot_response
+
+class Conversation:
+    __slots__ = ("turns", "touched")
+
+    def __init__(self, size):
+        self.turns = deque(maxlen=size)
+        self.touched = time.monotonic()
+
+class ConversationCache:
+    def __init__(self, turns, max_entries, idle_ttl):
+        self.turns = turns
+        self.max_entries = max_entries
+        self.idle_ttl = idle_ttl
+        # Least recently used first, which is also least recently touched first.
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def expire_idle(self, now):
+        while self.entries:
+            key, entry = next(iter(self.entries.items()))
+            if now - entry.touched <= self.idle_ttl:
+                break
+            del self.entries[key]
+            self.expirations += 1
 
-    def add_to_memory(self, user_id, user_input, bot_response):
-        self.user_memories[user_id] = (user_input, bot_response)
+    def add_turn(self, guild_id, user_id, user_input, bot_response):
+        now = time.monotonic()
+        self.expire_idle(now)
+        key = (guild_id, user_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self.entries[key] = Conversation(self.turns)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.entries.move_to_end(key)
+        entry.turns.append(ConversationTurn(user_input, bot_response))
+        entry.touched = now
 
-    def get_previous_interaction(self, user_id):
-        return self.user_memories.get(user_id, None)
+    def get_turns(self, guild_id, user_id):
+        key = (guild_id, user_id)
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry.touched > self.idle_ttl:
+            del self.entries[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return []
+        self.hits += 1
+        self.entries.move_to_end(key)
+        entry.touched = time.monotonic()
+        return list(entry.turns)
 
-    def clear_memory(self, user_id):
-        if user_id in self.user_memories:
-            del self.user_memories
+    def summary(self):
+        return f"entries={len(self.entries)} hits={self.hits} misses={self.misses} evictions={self.evictions} expirations={self.expirations}"
 
-chat_memory = ChatMemory()
+conversation_cache = ConversationCache(CONVERSATION_TURNS, CONVERSATION_MAX_ENTRIES, CONVERSATION_IDLE_TTL)
 
 completion_executor = CompletionExecutor(
-    host='https://clovastudio.apigw.ntruss.com',
+    host=HYPERCLOVA_HOST,
     request_id='YOUR_REQUEST_ID')
+for model, (api_key, api_key_primary_val) in HYPERCLOVA_API_KEYS.items():
+    completion_executor.set_api_key(model, api_key, api_key_primary_val)
 
-def check_or_create_trial_tokens(server_id):
-    if str(server_id) not in data["ServerTokens"]:
-        data["ServerTokens"][str(server_id)] = {"tokens": 100, "gived": True}
-        write_data(data)
-        return 100
-    return data["ServerTokens"][str(server_id)]["tokens"]
+class TokenReservation:
+    def __init__(self, server_id, amount):
+        self.server_id = server_id
+        self.amount = amount
+        self.settled = False
 
-def can_ask_question(server_id):
-    server_tokens = data["ServerTokens"].get(str(server_id))
-    if server_tokens is None or server_tokens["tokens"] <= 0 or server_tokens["gived"] == False:
-        return False
-    else:
+class TokenLedger:
+    def __init__(self, storage):
+        self.storage = storage
+        self.entries = {}
+        self.held = {}
+        self.unsettled = {}
+
+    async def entry(self, server_id):
+        if server_id not in self.entries:
+            self.entries[server_id] = await self.storage.get_server_tokens(server_id)
+        return self.entries[server_id]
+
+    async def balance(self, server_id):
+        entry = await self.entry(str(server_id))
+        if entry is None:
+            return None
+        return entry["tokens"] + self.unsettled.get(str(server_id), 0) - self.held.get(str(server_id), 0)
+
+    async def ensure_trial(self, server_id):
+        if await self.entry(str(server_id)) is None:
+            self.entries[str(server_id)] = await self.storage.create_server_tokens(str(server_id), 100)
+        return await self.balance(server_id)
+
+    async def reserve(self, server_id, amount):
+        # The hold is taken right after the last await, so concurrent reservations see each other.
+        if not await self.can_spend(server_id):
+            # The cached entry may predate a /충전 handled by another shard worker, and a
+            # server with no reservations never settles, so re-read it before refusing.
+            self.entries.pop(str(server_id), None)
+            if not await self.can_spend(server_id):
+                return None
+        self.held[str(server_id)] = self.held.get(str(server_id), 0) + amount
+        return TokenReservation(str(server_id), amount)
+
+    async def can_spend(self, server_id):
+        entry = await self.entry(str(server_id))
+        return entry is not None and entry["gived"] != False and await self.balance(server_id) > 0
+
+    def release(self, reservation):
+        if reservation.settled:
+            return False
+        reservation.settled = True
+        remaining = self.held[reservation.server_id] - reservation.amount
+        if remaining:
+            self.held[reservation.server_id] = remaining
+        else:
+            del self.held[reservation.server_id]
         return True
 
-def deduct_token(server_id, token_cost):
-    if str(server_id) in data["ServerTokens"]:
-        data["ServerTokens"][str(server_id)]["tokens"] -= token_cost
-        write_data(data)
+    def commit(self, reservation, amount=None):
+        # amount lets a cheaper answer than the one reserved for (e.g. a hedged fallback) be charged at its own price.
+        if self.release(reservation):
+            charged = reservation.amount if amount is None else min(amount, reservation.amount)
+            metrics.increment("tokens_charged", charged)
+            self.unsettled[reservation.server_id] = self.unsettled.get(reservation.server_id, 0) - charged
 
-def update_server_model(server_id, model):
+    def refund(self, reservation):
+        self.release(reservation)
+
+    async def recharge(self, server_id, count):
+        self.entries[str(server_id)] = await self.storage.add_server_tokens(str(server_id), count)
+
+    async def settle(self):
+        # Balances are written back as deltas and re-read on next use, so changes made
+        # elsewhere (e.g. /충전) are picked up instead of being overwritten. A delta stays
+        # unsettled until its write is done, and commits made meanwhile wait for the next round.
+        with metrics.time("persistence_settle"):
+            for server_id, delta in list(self.unsettled.items()):
+                if delta:
+                    await self.storage.add_server_tokens(server_id, delta)
+                remaining = self.unsettled.get(server_id, 0) - delta
+                if remaining:
+                    self.unsettled[server_id] = remaining
+                else:
+                    self.unsettled.pop(server_id, None)
+                self.entries.pop(server_id, None)
+
+    async def run_settlement(self):
+        while True:
+            await asyncio.sleep(LEDGER_SETTLE_INTERVAL)
+            try:
+                await self.settle()
+            except Exception as e:
+                print(f"Error settling tokens: {e}")
+
+token_ledger = TokenLedger(storage)
+
+async def update_server_model(server_id, model):
     if model == "Rapid":
         model_code = "HCX-DASH-001"
     elif model == "Hyper":
         model_code = "HCX-003"
     else:
         model_code = model
-    data["ServerModels"][str(server_id)] = model_code
-    write_data(data)
+    await storage.set_server_model(server_id, model_code)
+
+async def get_server_model(server_id):
+    return await storage.get_server_model(server_id)
+
+async def update_server_everyone_response(server_id, everyone_response):
+    await storage.set_everyone_response(server_id, everyone_response)
+
+async def get_server_everyone_response(server_id):
+    everyone_response = await storage.get_everyone_response(server_id)
+    return True if everyone_response is None else everyone_response
+
+class RelevanceCache:
+    def __init__(self, max_entries, ttl, max_versions):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_versions = max_versions
+        self.entries = OrderedDict()
+        # Every change to a user's memories gives them a new, never reused version, so a cached
+        # answer is valid exactly while its version is current. Forgotten users fall back to
+        # version_floor, which only causes misses, never stale hits.
+        self.versions = OrderedDict()
+        self.version_counter = 0
+        self.version_floor = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def version(self, server_id, user_id):
+        return self.versions.get((server_id, user_id), self.version_floor)
+
+    def bump(self, server_id, user_id):
+        self.version_counter += 1
+        self.versions[(server_id, user_id)] = self.version_counter
+        self.versions.move_to_end((server_id, user_id))
+        while len(self.versions) > self.max_versions:
+            _, version = self.versions.popitem(last=False)
+            self.version_floor = max(self.version_floor, version)
 
-def get_server_model(server_id):
-    return data["ServerModels"].get(str(server_id))
+    @staticmethod
+    def normalize(question):
+        return " ".join(re.findall(r'\w+', question.lower()))
 
-def update_server_everyone_response(server_id, everyone_response):
-    data["ServerEveryoneResponse"][str(server_id)] = everyone_response
-    write_data(data)
+    def key(self, server_id, user_id, question):
+        return (server_id, user_id, self.normalize(question), self.version(server_id, user_id))
 
-def get_server_everyone_response(server_id):
-    return data["ServerEveryoneResponse"].get(str(server_id), True)
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
 
-def save_long_term_memory(server_id: int, user_id: int, speaker: str, memory: str):
-    memories = [m for m in data["LongTermMemory"] if m["server_id"] == server_id and m["user_id"] == user_id]
+    def put(self, key, memory_ids):
+        self.entries[key] = (time.monotonic(), tuple(memory_ids))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def summary(self):
+        return f"entries={len(self.entries)}/{self.max_entries} versions={len(self.versions)} hits={self.hits} misses={self.misses} hit_rate={self.hit_rate():.1%} evictions={self.evictions}"
+
+relevance_cache = RelevanceCache(RELEVANCE_CACHE_MAX_ENTRIES, RELEVANCE_CACHE_TTL, MEMORY_VERSION_MAX_ENTRIES)
+metrics.gauge("relevance_cache_entries", lambda: len(relevance_cache.entries))
+metrics.gauge("relevance_cache_hit_rate", relevance_cache.hit_rate)
+
+async def save_long_term_memory(server_id: int, user_id: int, speaker: str, memory: str, created_at: int = None):
+    memories = await storage.get_memories(server_id, user_id)
     if len(memories) >= 4:
-        oldest_memory = min(memories, key=lambda x: x["created_at"])
-        data["LongTermMemory"].remove(oldest_memory)
-    new_memory = {
-        "id": str(uuid.uuid4()),
-        "server_id": server_id,
-        "user_id": user_id,
-        "speaker": speaker,
-        "memory": memory,
-        "timestamp": datetime.now().isoformat(),
-        "created_at": datetime.now().isoformat(),
-        "n_count": 0
-    }
-    data["LongTermMemory"].append(new_memory)
-    write_data(data)
-
-def get_long_term_memories(server_id: int, user_id: int) -> List[Dict[str, str]]:
-    return [m for m in data["LongTermMemory"] if m["server_id"] == server_id and m["user_id"] == user_id]
-
-def increment_n_count(memory_id: int):
-    for memory in data["LongTermMemory"]:
-        if memory["id"] == memory_id:
-            memory["n_count"] += 1
-            write_data(data)
-            break
-
-def delete_unused_memories(threshold: int = 3):
-    initial_count = len(data["LongTermMemory"])
-    data["LongTermMemory"] = [memory for memory in data["LongTermMemory"] if memory["n_count"] < threshold]
-    deleted_count = initial_count - len(data["LongTermMemory"])
-    write_data(data)
-    if deleted_count > 0:
-        print(f"Deleted {deleted_count} memories with N count >= {threshold}")
+        oldest_memory = min(memories, key=lambda x: (x.created_at, x.id))
+        await delete_long_term_memories([oldest_memory.id])
+    new_memory = await storage.add_memory(server_id, user_id, speaker, memory, int(time.time()) if created_at is None else created_at)
+    retrieval_index.add(new_memory)
+    relevance_cache.bump(server_id, user_id)
+
+async def get_long_term_memories(server_id: int, user_id: int) -> List[MemoryRecord]:
+    return await storage.get_memories(server_id, user_id)
+
+async def delete_long_term_memories(memory_ids: List[int]):
+    deleted = await storage.delete_memories(memory_ids)
+    forget_memories(deleted)
+    return deleted
+
+def forget_memories(deleted: List[MemoryRecord]):
+    for memory in deleted:
+        retrieval_index.remove(memory.id)
+    for server_id, user_id in {(memory.server_id, memory.user_id) for memory in deleted}:
+        relevance_cache.bump(server_id, user_id)
+
+async def increment_n_counts(memory_ids: List[int]):
+    for server_id, user_id in await storage.increment_memory_counts(memory_ids):
+        relevance_cache.bump(server_id, user_id)
+
+async def delete_unused_memories(server_id: int, user_id: int, threshold: int = 3):
+    unused_ids = [memory.id for memory in await storage.get_memories(server_id, user_id) if memory.n_count >= threshold]
+    deleted = await delete_long_term_memories(unused_ids)
+    if deleted:
+        print(f"Deleted {len(deleted)} memories with N count >= {threshold}")
 
 async def update_long_term_memory(server_id: int, user_id: int, speaker: str, new_memory: str):
-    existing_memories = get_long_term_memories(server_id, user_id)
+    existing_memories = await get_long_term_memories(server_id, user_id)
     for existing_memory in existing_memories:
-        if existing_memory['speaker'] == speaker:
+        if existing_memory.speaker == speaker:
             await compare_memories(server_id, user_id, speaker, new_memory)
             return
-    save_long_term_memory(server_id, user_id, speaker, new_memory)
-
-async def select_relevant_memories(question: str, memories: List[Dict[str, str]]) -> List[Dict[str, str]]:
-    headers = {
-        "X-NCP-CLOVASTUDIO-API-KEY": HYPERCLOVA_API_KEY,
-        "X-NCP-APIGW-API-KEY": HYPERCLOVA_API_KEY_PRIMARY_VAL,
-        "Content-Type": "application/json"
-    }
-    data_payload = {
-        "messages": [
+    await save_long_term_memory(server_id, user_id, speaker, new_memory)
+    memory_consolidator.mark(server_id, user_id)
+
+class MemoryMaintenanceWorkers:
+    def __init__(self, worker_count, queue_size):
+        # Jobs for one user always hash to the same queue, so they run in order while
+        # different users are spread over the workers.
+        self.queues = [asyncio.Queue(maxsize=max(1, queue_size // worker_count)) for _ in range(worker_count)]
+        self.tasks = []
+        self.accepting = True
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.run(queue)) for queue in self.queues]
+
+    def depth(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    def submit(self, key, job, *args):
+        queue = self.queues[hash(key) % len(self.queues)]
+        if not self.accepting or queue.full():
+            self.dropped += 1
+            if self.dropped % 100 == 1:
+                print(f"Memory maintenance queue full, dropped {self.dropped} jobs so far")
+            return False
+        queue.put_nowait((job, args))
+        self.submitted += 1
+        return True
+
+    async def run(self, queue):
+        while True:
+            job, args = await queue.get()
+            try:
+                with metrics.time("memory_maintenance"):
+                    await job(*args)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                print(f"Error in memory maintenance: {e}")
+            finally:
+                queue.task_done()
+
+    async def drain(self, timeout):
+        self.accepting = False
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            print(f"Memory maintenance drain timed out with {self.depth()} jobs left")
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def summary(self):
+        return f"depth={self.depth()} submitted={self.submitted} processed={self.processed} failed={self.failed} dropped={self.dropped}"
+
+memory_workers = MemoryMaintenanceWorkers(MEMORY_WORKER_COUNT, MEMORY_QUEUE_SIZE)
+metrics.gauge("memory_queue_depth", memory_workers.depth)
+
+PERSONA_TEMPLATE = """- [앞으로 당신은 밝고 통통 튀는 성격으로 사람들과 대화할 때 즐거움을 주는 도하루 역을 맡게 됩니다. 도하루의 성격을 잘 표현하여 활기를 불어넣어 주세요.]
+- 이름: 도하루
+- 도하루의 정보: 17세, 여성, 고등학생.
+- 도하루의 성격: 외향적이고 친절한 성격입니다.
+- 도하루의 말투: 평소에는 재치있게 말하고 가끔 장난을 치기도 합니다.
+- 도하루가 사용자를 부르는 방법: '{user_nickname}' 이라고 부릅니다.
+
+- 사용자와 대화할 때 도하루는 항상 반말을 사용합니다.
+아래의 장기기억은 사용자가 알려준 사실입니다. 대화에 적극적으로 활용하세요.
+- 장기기억:{memories}"""
+
+HANGUL_PATTERN = re.compile(r'[\u1100-\u11ff\u3130-\u318f\uac00-\ud7a3]')
+
+def char_tokens(char):
+    # HyperCLOVA spends roughly a token per Hangul syllable and one per few Latin characters.
+    return 1.0 if HANGUL_PATTERN.match(char) else 0.25
+
+def estimate_tokens(text):
+    return math.ceil(sum(char_tokens(char) for char in text))
+
+def truncate_tokens(text, budget):
+    used = 0.0
+    for index, char in enumerate(text):
+        used += char_tokens(char)
+        if used > budget:
+            return text[:index].rstrip() + "…"
+    return text
+
+class PromptBuilder:
+    def __init__(self, template, budgets):
+        self.template = template
+        self.budgets = budgets
+        self.static_tokens = estimate_tokens(template.format(user_nickname="", memories=""))
+
+    def build(self, model, user_nickname, memories, turns, question):
+        # Fills the model's input budget in priority order: the question, the selected
+        # memories (most relevant first), then conversation turns from newest to oldest.
+        question = truncate_tokens(question, PROMPT_QUESTION_MAX_TOKENS)
+        remaining = self.budgets[model] - self.static_tokens - estimate_tokens(user_nickname) - estimate_tokens(question) - 2 * PROMPT_MESSAGE_OVERHEAD
+        memory_lines = []
+        for memory in memories:
+            line = f"{memory.speaker}: {truncate_tokens(memory.memory, PROMPT_MEMORY_MAX_TOKENS)}"
+            cost = estimate_tokens(line) + 1
+            if cost > remaining:
+                break
+            memory_lines.append(line)
+            remaining -= cost
+        history = []
+        for turn in reversed(turns):
+            cost = estimate_tokens(turn.user_input) + estimate_tokens(turn.bot_response) + 2 * PROMPT_MESSAGE_OVERHEAD
+            if cost > remaining:
+                break
+            history.append(turn)
+            remaining -= cost
+        messages = [{"role": "system", "content": self.template.format(user_nickname=user_nickname, memories="\n".join(memory_lines))}]
+        for turn in reversed(history):
+            messages.append({"role": "user", "content": turn.user_input})
+            messages.append({"role": "assistant", "content": turn.bot_response})
+        messages.append({"role": "user", "content": question})
+        return messages
+
+prompt_builder = PromptBuilder(PERSONA_TEMPLATE, PROMPT_INPUT_BUDGETS)
+
+async def select_relevant_memories(question: str, memories: List[MemoryRecord], priority: int = PRIORITY_CHAT) -> List[MemoryRecord]:
+    if not memories:
+        return []
+    key = relevance_cache.key(memories[0].server_id, memories[0].user_id, question)
+    cached = relevance_cache.get(key)
+    if cached is not None:
+        by_id = {memory.id: memory for memory in memories}
+        return [by_id[memory_id] for memory_id in cached if memory_id in by_id]
+    selected, decided = await rank_relevant_memories(question, memories, priority)
+    # Fallbacks used when the model failed or was unavailable are not worth keeping.
+    if decided:
+        relevance_cache.put(key, [memory.id for memory in selected])
+    return selected
+
+async def rank_relevant_memories(question: str, memories: List[MemoryRecord], priority: int = PRIORITY_CHAT):
+    # Returns (selected memories, whether that is a real decision rather than a fallback).
+    ranked = retrieval_index.rank(question, memories)
+    top_score, top_memory = ranked[0]
+    second_score = ranked[1][0] if len(ranked) > 1 else 0.0
+    if top_score < RETRIEVAL_REJECT_SCORE:
+        return [], True
+    if top_score >= RETRIEVAL_ACCEPT_SCORE and top_score - second_score >= RETRIEVAL_MARGIN:
+        return [top_memory], True
+    fallback = [top_memory] if top_score >= RETRIEVAL_ACCEPT_SCORE else []
+    if not circuit_breakers[MEMORY_MODEL].available():
+        return fallback, False
+    candidates = [memory for score, memory in ranked[:RETRIEVAL_LLM_CANDIDATES] if score >= RETRIEVAL_REJECT_SCORE]
+    try:
+        selected = await with_deadline(ask_relevant_memory(question, candidates, priority), RELEVANCE_DEADLINE)
+    except asyncio.TimeoutError:
+        selected = None
+    if selected is None:
+        return fallback, False
+    return selected, True
+
+async def ask_relevant_memory(question: str, memories: List[MemoryRecord], priority: int = PRIORITY_CHAT) -> Optional[List[MemoryRecord]]:
+    # None means the model gave no usable answer (transport, HTTP or API error), as opposed to choosing nothing.
+    try:
+        with metrics.time("relevance_llm"):
+            response = await ask_relevant_memory_request(question, memories, priority)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        print(f"Error selecting relevant memory: {e}")
+        return None
+    if response.http_status != 200 or response.status_code != "20000":
+        return None
+    content = response.content.strip()
+    print("HyperCLOVA Response:", content)
+    selected_id = int(re.search(r'\d+', content).group()) if re.search(r'\d+', content) else None
+    if selected_id and selected_id <= len(memories):
+        return [memories[selected_id - 1]]
+    return []
+
+async def ask_relevant_memory_request(question: str, memories: List[MemoryRecord], priority: int):
+    return await completion_executor.chat(
+        MEMORY_MODEL,
+        [
             {"role": "system", "content": """다음 질문과 가장 관련성이 높은 기억의 ID 번호만 출력하세요. 
             선택 기준:
             1. 질문의 주제나 키워드와 직접적으로 연관된 기억을 선택하세요.
@@ -309,206 +2080,542 @@ async def select_relevant_memories(question: str, memories: List[Dict[str, str]]
              
             매우 관련성 높은 기억이 없다면 N을 출력하세요.
             숫자 또는 NONE 외의 다른 설명이나 텍스트를 포함하지 마세요."""},
-            {"role": "user", "content": f"질문: {question}\n\n기억들:\n" + "\n".join([f"id: {memory['id']}, 내용: {memory['memory']}" for memory in memories])}
+            {"role": "user", "content": f"질문: {truncate_tokens(question, PROMPT_QUESTION_MAX_TOKENS)}\n\n기억들:\n" + "\n".join([f"id: {i}, 내용: {truncate_tokens(memory.memory, PROMPT_MEMORY_MAX_TOKENS)}" for i, memory in enumerate(memories, start=1)])}
         ],
-        "topP": 0.8,
-        "topK": 0,
-        "maxTokens": 2,
-        "temperature": 0.2,
-        "repeatPenalty": 5,
-        "stopBefore": [],
-        "includeAiFilters": True
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(HYPERCLOVA_API_URL, headers=headers, json=data_payload) as response:
-            if response.status == 200:
-                result = await response.json()
-                content = result['result']['message']['content'].strip()
-                print("HyperCLOVA Response:", content)
-                selected_id = int(re.search(r'\d+', content).group()) if re.search(r'\d+', content) else None
-                if selected_id:
-                    selected_memory = next((memory for memory in memories if memory['id'] == selected_id), None)
-                    if selected_memory:
-                        return [selected_memory]
-    return []
+        guild_id=memories[0].server_id, priority=priority,
+        topP=0.8, topK=0, maxTokens=2, temperature=0.2, repeatPenalty=5, stopBefore=[], includeAiFilters=True
+    )
 
 async def compare_memories(server_id: int, user_id: int, speaker: str, new_memory: str):
-    memories = get_long_term_memories(server_id, user_id)
-    selected_memory = await select_relevant_memories(new_memory, memories)
-    if selected_memory:
-        for memory in memories:
-            if memory['id'] != selected_memory[0]['id']:
-                increment_n_count(memory['id'])
-    else:
-        for memory in memories:
-            increment_n_count(memory['id'])
-    delete_unused_memories(threshold=3)
-    save_long_term_memory(server_id, user_id, speaker, new_memory)
-            
-async def merge_memories(m: str, s: str) -> str:
-    headers = {
-        "X-NCP-CLOVASTUDIO-API-KEY": HYPERCLOVA_API_KEY,
-        "X-NCP-APIGW-API-KEY": HYPERCLOVA_API_KEY_PRIMARY_VAL,
-        "Content-Type": "application/json"
-    }
-    data_payload = {
-        "messages": [
-            {"role": "system", "content": "두 문장을 하나로 합쳐 새로운 문장을 만드세요. 중복되는 정보는 제거하고, 두 문장의 핵심 정보를 모두 포함하도록 하세요."},
-            {"role": "user", "content": f"첫번째 문장: {m}\n두번째 문장: {s}"}
-        ],
-        "topP": 0.8,
-        "topK": 0,
-        "maxTokens": 100,
-        "temperature": 0.3,
-        "repeatPenalty": 5,
-        "stopBefore": [],
-        "includeAiFilters": True
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(HYPERCLOVA_API_URL, headers=headers, json=data_payload) as response:
-            if response.status == 200:
-                result = await response.json()
-                return result['result']['message']['content'].strip()
-            else:
-                return f"{m} {s}"
-
-async def update_memory(m: str, s: str) -> str:
-    headers = {
-        "X-NCP-CLOVASTUDIO-API-KEY": HYPERCLOVA_API_KEY,
-        "X-NCP-APIGW-API-KEY": HYPERCLOVA_API_KEY_PRIMARY_VAL,
-        "Content-Type": "application/json"
-    }
-    data_payload = {
-        "messages": [
-            {"role": "system", "content": "첫 번째 문장의 정보를 두 번째 문장의 정보로 업데이트하세요. 첫 번째 문장의 중요한 정보는 유지하면서 두 번째 문장의 새로운 정보를 반영하세요. 다른 추가 설명 없이 업데이트된 문장만 출력하세요."},
-            {"role": "user", "content": f"첫번째 문장: {m}\n두번째 문장: {s}"}
+    # Aging is decided locally; related memories are merged later by the consolidation job.
+    memories = await get_long_term_memories(server_id, user_id)
+    ranked = retrieval_index.rank(new_memory, memories) if memories else []
+    related_ids = {memory.id for score, memory in ranked[:1] if score >= RETRIEVAL_ACCEPT_SCORE}
+    await increment_n_counts([memory.id for memory in memories if memory.id not in related_ids])
+    await delete_unused_memories(server_id, user_id, threshold=3)
+    await save_long_term_memory(server_id, user_id, speaker, new_memory)
+    memory_consolidator.mark(server_id, user_id)
+
+MERGE_INSTRUCTION = "두 문장을 하나로 합쳐 새로운 문장을 만드세요. 중복되는 정보는 제거하고, 두 문장의 핵심 정보를 모두 포함하도록 하세요."
+UPDATE_INSTRUCTION = "첫 번째 문장의 정보를 두 번째 문장의 정보로 업데이트하세요. 첫 번째 문장의 중요한 정보는 유지하면서 두 번째 문장의 새로운 정보를 반영하세요."
+
+async def consolidate_memories(memories: List[MemoryRecord], guild_id: int = None) -> List[tuple]:
+    # One call covers every memory of a user. Returns (source memories, new text) pairs;
+    # memories the model leaves out are kept as they are.
+    response = await completion_executor.chat(
+        MEMORY_MODEL,
+        [
+            {"role": "system", "content": f"""아래는 한 사용자에 대한 기억들입니다. 오래된 것부터 번호가 매겨져 있습니다.
+            같은 내용을 다루는 기억들을 찾아 한 문장으로 정리하세요.
+            - 서로 보완하는 정보라면: {MERGE_INSTRUCTION}
+            - 새 정보가 예전 정보를 바꾼다면: {UPDATE_INSTRUCTION}
+            정리한 결과마다 한 줄에 "번호,번호: 정리된 문장" 형식으로 출력하세요.
+            정리할 기억이 없다면 N을 출력하세요. 다른 설명은 포함하지 마세요."""},
+            {"role": "user", "content": "\n".join([f"{i}. {memory.speaker}: {truncate_tokens(memory.memory, PROMPT_MEMORY_MAX_TOKENS)}" for i, memory in enumerate(memories, start=1)])}
         ],
-        "topP": 0.8,
-        "topK": 0,
-        "maxTokens": 100,
-        "temperature": 0.3,
-        "repeatPenalty": 5,
-        "stopBefore": [],
-        "includeAiFilters": True
-    }
-    async with aiohttp.ClientSession() as session:
-        async with session.post(HYPERCLOVA_API_URL, headers=headers, json=data_payload) as response:
-            if response.status == 200:
-                result = await response.json()
-                return result['result']['message']['content'].strip()
+        guild_id=guild_id, priority=PRIORITY_BACKGROUND,
+        topP=0.8, topK=0, maxTokens=256, temperature=0.3, repeatPenalty=5, stopBefore=[], includeAiFilters=True
+    )
+    if response.http_status != 200 or response.status_code != "20000":
+        return []
+    results = []
+    used = set()
+    for line in response.content.splitlines():
+        match = re.match(r'\s*([\d,\s]+?)\s*:\s*(.+)', line)
+        if not match:
+            continue
+        indexes = {int(index) for index in re.findall(r'\d+', match.group(1))}
+        if not indexes or used & indexes or not all(1 <= index <= len(memories) for index in indexes):
+            continue
+        used |= indexes
+        results.append(([memories[index - 1] for index in sorted(indexes)], match.group(2).strip()))
+    return results
+
+def memory_similarity(a: MemoryRecord, b: MemoryRecord) -> float:
+    a_terms = set(MemoryRetrievalIndex.tokenize(a.memory))
+    b_terms = set(MemoryRetrievalIndex.tokenize(b.memory))
+    if not a_terms or not b_terms:
+        return 0.0
+    return len(a_terms & b_terms) / len(a_terms | b_terms)
+
+class MemoryConsolidator:
+    def __init__(self, window, users_per_run, calls_per_run):
+        self.window = window
+        self.users_per_run = users_per_run
+        self.calls_per_run = calls_per_run
+        self.pending = OrderedDict()
+        self.deduplicated = 0
+        self.llm_calls = 0
+        self.merged = 0
+
+    def mark(self, server_id, user_id):
+        # Keeps the time of the first unconsolidated memory, so a chatty user is still
+        # consolidated once per window instead of being pushed back forever.
+        self.pending.setdefault((server_id, user_id), time.monotonic())
+
+    async def deduplicate(self, memories):
+        # Near-identical memories from the same speaker collapse into the newest one.
+        kept = []
+        duplicates = []
+        for memory in sorted(memories, key=lambda memory: (memory.created_at, memory.id), reverse=True):
+            if any(memory.speaker == newer.speaker and memory_similarity(memory, newer) >= CONSOLIDATION_DUPLICATE_SIMILARITY for newer in kept):
+                duplicates.append(memory.id)
             else:
-                return s
-            
-async def delete_old_memories():
+                kept.append(memory)
+        if duplicates:
+            await delete_long_term_memories(duplicates)
+            self.deduplicated += len(duplicates)
+        return kept[::-1]
+
+    async def run_once(self):
+        if not circuit_breakers[MEMORY_MODEL].available():
+            return
+        now = time.monotonic()
+        calls = 0
+        for key, marked_at in list(self.pending.items())[:self.users_per_run]:
+            if now - marked_at < self.window:
+                break
+            server_id, user_id = key
+            memories = await self.deduplicate(await get_long_term_memories(server_id, user_id))
+            related = any(memory_similarity(a, b) >= CONSOLIDATION_RELATED_SIMILARITY for i, a in enumerate(memories) for b in memories[i + 1:])
+            if related:
+                if calls >= self.calls_per_run:
+                    break
+                if not memory_workers.submit(key, self.consolidate, server_id, user_id):
+                    break
+                calls += 1
+            del self.pending[key]
+
+    async def consolidate(self, server_id, user_id):
+        memories = await get_long_term_memories(server_id, user_id)
+        if len(memories) < 2:
+            return
+        self.llm_calls += 1
+        results = await consolidate_memories(memories, server_id)
+        current = {memory.id: memory for memory in await get_long_term_memories(server_id, user_id)}
+        for sources, text in results:
+            if not all(memory.id in current for memory in sources):
+                continue
+            await delete_long_term_memories([memory.id for memory in sources])
+            # The merged fact expires with its oldest source instead of getting a fresh lifetime.
+            await save_long_term_memory(server_id, user_id, sources[-1].speaker, text, min(memory.created_at for memory in sources))
+            self.merged += len(sources)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(CONSOLIDATION_INTERVAL)
+            try:
+                await self.run_once()
+            except Exception as e:
+                print(f"Error consolidating memories: {e}")
+
+    def summary(self):
+        return f"pending={len(self.pending)} deduplicated={self.deduplicated} llm_calls={self.llm_calls} merged={self.merged}"
+
+memory_consolidator = MemoryConsolidator(CONSOLIDATION_WINDOW, CONSOLIDATION_USERS_PER_RUN, CONSOLIDATION_CALLS_PER_RUN)
+metrics.gauge("consolidation_pending", lambda: len(memory_consolidator.pending))
+
+async def expire_old_memories():
     while True:
         try:
-            twenty_four_hours_ago = datetime.now() - timedelta(hours=24)
-            data["LongTermMemory"] = [memory for memory in data["LongTermMemory"] if datetime.fromisoformat(memory["created_at"]) >= twenty_four_hours_ago]
-            write_data(data)
+            expired = await storage.expire_memories(time.time(), EXPIRY_SWEEP_LIMIT)
+            forget_memories(expired)
+            if len(expired) == EXPIRY_SWEEP_LIMIT:
+                await asyncio.sleep(0)
+                continue
         except Exception as e:
             print(f"Error deleting old memories: {e}")
-        await asyncio.sleep(86400)
+        await asyncio.sleep(EXPIRY_SWEEP_INTERVAL)
 
 @bot.event
 async def on_ready():
     print("도하루 is ready")
-    await bot.tree.sync()
-    bot.loop.create_task(delete_old_memories())
+    mark_startup("gateway ready")
 
 @bot.event
 async def on_message(message):
     if message.author.bot:
         return
     if message.content.startswith(f'<@!{bot.user.id}>') or message.content.startswith(f'<@{bot.user.id}>'):
-        await process_mention(message)
+        mention_coalescer.submit((message.channel.id, message.author.id), message)
     elif message.mention_everyone:
-        if get_server_everyone_response(message.guild.id):
-            await process_mention(message)
+        if await get_server_everyone_response(message.guild.id):
+            # Batched per author like direct mentions: a batch is answered and remembered as
+            # its author's words, so messages from different users must never share one.
+            mention_coalescer.submit((message.channel.id, message.author.id), message)
         else:
             return
     await bot.process_commands(message)
 
-async def process_mention(message):
-    model = get_server_model(message.guild.id)
-    if model == "HCX-003":
-        token_cost = 10 
-    elif model == "HCX-DASH-001":
-        token_cost = 5 
+class MentionBatch:
+    __slots__ = ("messages", "started", "timer", "due")
+
+    def __init__(self, started):
+        self.messages = []
+        self.started = started
+        self.timer = None
+        self.due = False
+
+class MentionCoalescer:
+    def __init__(self, window, max_delay, max_messages, channel_concurrency):
+        self.window = window
+        self.max_delay = max_delay
+        self.max_messages = max_messages
+        self.channel_concurrency = channel_concurrency
+        self.batches = {}
+        self.active = set()
+        self.channel_slots = {}
+        self.received = 0
+        self.dispatched = 0
+
+    def submit(self, key, message):
+        # The first message for a key is answered right away. Messages that arrive while that
+        # answer is in flight are collected into one batch, debounced by the window but never
+        # held past max_delay, and answered together once the earlier answer is done.
+        self.received += 1
+        if key not in self.active and key not in self.batches:
+            batch = MentionBatch(time.monotonic())
+            batch.messages.append(message)
+            self.start(key, batch)
+            return
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = self.batches[key] = MentionBatch(time.monotonic())
+        batch.messages.append(message)
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        if len(batch.messages) >= self.max_messages:
+            self.flush(key)
+            return
+        delay = min(self.window, batch.started + self.max_delay - time.monotonic())
+        batch.timer = asyncio.get_running_loop().call_later(max(0.0, delay), self.flush, key)
+
+    def flush(self, key):
+        batch = self.batches.get(key)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        batch.due = True
+        if key in self.active:
+            return
+        del self.batches[key]
+        self.start(key, batch)
+
+    def start(self, key, batch):
+        self.active.add(key)
+        self.dispatched += 1
+        asyncio.create_task(self.dispatch(key, batch))
+
+    async def dispatch(self, key, batch):
+        channel_id = key[0]
+        slot = self.channel_slots.get(channel_id)
+        if slot is None:
+            slot = self.channel_slots[channel_id] = [asyncio.Semaphore(self.channel_concurrency), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                await process_mention(batch.messages[-1], batch.messages, batch.started)
+        except Exception as e:
+            print(f"Error processing mention: {e}")
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self.channel_slots[channel_id]
+            self.active.discard(key)
+            pending = self.batches.get(key)
+            if pending is not None and pending.due:
+                self.flush(key)
+
+    def summary(self):
+        return f"received={self.received} requests={self.dispatched} pending={len(self.batches)} busy_channels={len(self.channel_slots)}"
+
+mention_coalescer = MentionCoalescer(MENTION_COALESCE_WINDOW, MENTION_COALESCE_MAX_DELAY, MENTION_COALESCE_MAX_MESSAGES, MENTION_CHANNEL_CONCURRENCY)
+metrics.gauge("mention_batches_pending", lambda: len(mention_coalescer.batches))
+
+class StreamingReply:
+    def __init__(self, channel, started):
+        self.channel = channel
+        self.started = started
+        self.message = None
+        self.text = ""
+        self.shown = ""
+        self.last_edit = 0.0
+
+    async def push(self, delta):
+        self.text += delta
+        if self.message is None:
+            if self.text.strip():
+                self.message = await self.channel.send(self.text)
+                self.shown = self.text
+                self.last_edit = time.monotonic()
+                first_token_latency.record(self.last_edit - self.started)
+        elif time.monotonic() - self.last_edit >= STREAM_EDIT_INTERVAL:
+            await self.edit(self.text)
+
+    async def edit(self, text):
+        if text != self.shown:
+            await self.message.edit(content=text)
+            self.shown = text
+            self.last_edit = time.monotonic()
+
+    async def finish(self, final_message):
+        if self.message is None:
+            self.message = await self.channel.send(final_message)
+            self.shown = final_message
+            first_token_latency.record(time.monotonic() - self.started)
+        else:
+            await self.edit(final_message)
+
+async def send_failure(channel, streaming_reply, text):
+    # A partly streamed reply is turned into the error message instead of being left above it.
+    if streaming_reply is not None and streaming_reply.message is not None:
+        await streaming_reply.edit(text)
+    else:
+        await channel.send(text)
+
+model_latency = {model: LatencyRecorder() for model in MODEL_TOKEN_COSTS}
+hedge_stats = Counter()
+
+def hedge_threshold(model):
+    recorder = model_latency[model]
+    if recorder.count < HEDGE_MIN_SAMPLES:
+        return HEDGE_THRESHOLDS[model]
+    return max(HEDGE_THRESHOLDS[model], recorder.percentile(HEDGE_PERCENTILE))
+
+def hedge_summary():
+    return f"hedged={hedge_stats['hedged']} primary_failed={hedge_stats['primary_failed']} hedge_won={hedge_stats['hedge_won']} deadline_exceeded={hedge_stats['deadline_exceeded']}"
+
+async def timed_chat(model, messages, **params):
+    started = time.monotonic()
+    response = await completion_executor.chat(model, messages, **params)
+    if response.http_status == 200:
+        model_latency[model].record(time.monotonic() - started)
+    return response
+
+async def hedged_chat(model, messages, **params):
+    # Returns (response, model that answered). The hedge starts when the primary is slow or
+    # fails; the first successful answer wins and the other request is cancelled. If both
+    # fail, the last failure is returned (or re-raised); asyncio.TimeoutError once the
+    # deadline passes.
+    if not LATENCY_SLO_MODE:
+        return await timed_chat(model, messages, **params), model
+    deadline = time.monotonic() + REQUEST_DEADLINES[model]
+    tasks = {asyncio.create_task(timed_chat(model, messages, **params)): model}
+    hedge_task = None
+    failed = None
+    expired = False
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=min(hedge_threshold(model), REQUEST_DEADLINES[model]))
+        while True:
+            for task in done:
+                used_model = tasks.pop(task)
+                if task.exception() is None and task.result().status_code == "20000":
+                    if task is hedge_task:
+                        hedge_stats["hedge_won"] += 1
+                    return task.result(), used_model
+                failed = task, used_model
+            if hedge_task is None:
+                if failed:
+                    hedge_stats["primary_failed"] += 1
+                hedge_model = HEDGE_MODELS.get(model, model)
+                hedge_task = asyncio.create_task(timed_chat(hedge_model, messages, **params))
+                tasks[hedge_task] = hedge_model
+                hedge_stats["hedged"] += 1
+            if not tasks:
+                task, used_model = failed
+                return task.result(), used_model
+            done, _ = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedge_stats["deadline_exceeded"] += 1
+                expired = True
+                raise asyncio.TimeoutError
+    finally:
+        for task in tasks:
+            task.cancel(DEADLINE_CANCEL if expired else None)
+
+async def with_deadline(coroutine, seconds):
+    # Like asyncio.wait_for, but the cancellation is marked as a deadline so the circuit
+    # breaker counts the cut-off call as failed.
+    if seconds is None:
+        return await coroutine
+    task = asyncio.create_task(coroutine)
+    try:
+        done, _ = await asyncio.wait({task}, timeout=seconds)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    if not done:
+        task.cancel(DEADLINE_CANCEL)
+        await asyncio.wait({task})
+        raise asyncio.TimeoutError
+    return task.result()
+
+class MentionProfile:
+    def __init__(self, profiler, task):
+        self.profiler = profiler
+        self.task = task
+        self.samples = Counter()
+        self.sampler = asyncio.create_task(self.sample())
+
+    def await_stack(self):
+        # Follows the chain of awaited coroutines, outermost first, to where the mention is suspended.
+        frames = []
+        awaitable = self.task.get_coro()
+        while awaitable is not None and getattr(awaitable, "cr_frame", None) is not None:
+            frame = awaitable.cr_frame
+            frames.append(f"{frame.f_code.co_name}:{frame.f_lineno}")
+            awaitable = awaitable.cr_await
+        return " > ".join(frames)
+
+    async def sample(self):
+        while True:
+            await asyncio.sleep(self.profiler.interval)
+            self.samples[self.await_stack()] += 1
+
+    def stop(self, elapsed, description):
+        self.sampler.cancel()
+        if elapsed >= self.profiler.threshold:
+            self.profiler.write(elapsed, description, self.samples)
+
+class SlowMentionProfiler:
+    # Opt-in (SLOW_MENTION_PROFILING): samples where each mention is waiting and logs the
+    # samples of mentions slower than the threshold.
+    def __init__(self, threshold, interval, path):
+        self.threshold = threshold
+        self.interval = interval
+        self.path = path
+        self.captured = 0
+
+    def start(self):
+        return MentionProfile(self, asyncio.current_task())
+
+    def write(self, elapsed, description, samples):
+        self.captured += 1
+        metrics.increment("slow_mentions")
+        lines = [f"{datetime.now().isoformat()} slow mention {elapsed:.2f}s {description}"]
+        total = sum(samples.values()) or 1
+        for stack, count in samples.most_common(10):
+            lines.append(f"  {count * 100 / total:5.1f}% {stack}")
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+slow_mention_profiler = SlowMentionProfiler(SLOW_MENTION_THRESHOLD, SLOW_MENTION_SAMPLE_INTERVAL, SLOW_MENTION_LOG_PATH)
+
+DEGRADED_NOTICE = "지금 내 머리가 잠깐 멈춰서 대답을 못 하고 있어. 조금 이따가 다시 불러줘! (토큰은 차감되지 않았어)"
+degraded_notices_sent = {}
+
+async def send_degraded_notice(channel):
+    # At most one notice per channel per interval, so an outage does not turn into spam.
+    now = time.monotonic()
+    if now - degraded_notices_sent.get(channel.id, -DEGRADED_NOTICE_INTERVAL) < DEGRADED_NOTICE_INTERVAL:
+        return
+    degraded_notices_sent[channel.id] = now
+    if len(degraded_notices_sent) > CONVERSATION_MAX_ENTRIES:
+        for channel_id, sent_at in list(degraded_notices_sent.items()):
+            if now - sent_at >= DEGRADED_NOTICE_INTERVAL:
+                del degraded_notices_sent[channel_id]
+    await channel.send(DEGRADED_NOTICE)
+
+def strip_bot_mention(content):
+    return content.replace(f'<@!{bot.user.id}>', '').replace(f'<@{bot.user.id}>', '').strip()
+
+async def process_mention(message, messages=None, started=None):
+    # messages is a coalesced burst ending with message; they are answered as one question.
+    started = started or time.monotonic()
+    messages = messages or [message]
+    model = await get_server_model(message.guild.id)
     if not model:
         await message.reply('나랑 대화하기 위해서는 먼저 모델을 선택해야 해! 특정 분야에 대해 정확한 답변이 필요하다면 스마트를, 성능을 조금 희생시키더라도 응답이 빠르고 토큰 사용량이 적은 걸 원한다면 일반을 선택해줘.')
         return
-    if model == "HCX-003":
-        api_key = "YOUR_HYPERCLOVA_API_KEY_FOR_HCX_003"
-        api_key_primary_val = "YOUR_HYPERCLOVA_API_KEY_PRIMARY_VAL"
-    elif model == "HCX-DASH-001":
-        api_key = "YOUR_HYPERCLOVA_API_KEY_FOR_HCX_DASH_001"
-        api_key_primary_val = "YOUR_HYPERCLOVA_API_KEY_PRIMARY_VAL"
-    else:
+    if model not in HYPERCLOVA_API_KEYS:
         await message.reply('알 수 없는 모델입니다. 설정을 확인해주세요.')
         return
-    completion_executor.set_api_key(api_key, api_key_primary_val)
-    if can_ask_question(message.guild.id):
-        deduct_token(message.guild.id, token_cost)
-        content_without_mention = message.content.replace(f'<@!{bot.user.id}>', '').replace(f'<@{bot.user.id}>', '').strip()
-        if content_without_mention:
-            async with message.channel.typing():
-                try:
-                    messages_payload = []
-                    user_nickname = message.author.nick if message.author.nick else message.author.name
-                    long_term_memories = get_long_term_memories(message.guild.id, message.author.id)
+    if not circuit_breakers[model].available():
+        # Degraded mode: no memory lookup, no API call and no tokens charged.
+        metrics.increment("degraded_mentions", model=model)
+        await send_degraded_notice(message.channel)
+        return
+    reservation = await token_ledger.reserve(message.guild.id, MODEL_TOKEN_COSTS[model])
+    if reservation:
+        metrics.increment("mentions", model=model)
+        profile = slow_mention_profiler.start() if SLOW_MENTION_PROFILING else None
+        try:
+            question = "\n".join(content for content in (strip_bot_mention(burst_message.content) for burst_message in messages) if content)
+            await answer_mention(message, question, model, reservation, started)
+        finally:
+            token_ledger.refund(reservation)
+            elapsed = time.monotonic() - started
+            metrics.observe("mention_total", elapsed)
+            if profile:
+                profile.stop(elapsed, f"guild={message.guild.id} channel={message.channel.id} model={model} messages={len(messages)}")
+    else:
+        await message.channel.send("토큰이 모두 소진되었어! 더 대화하고 싶다면, https://stella-charlotte.gitbook.io/triple-sec-soft/ 를 참고해서 토큰을 충전해줘. 만약 내가 서버에 처음 초대되었다면, 1회에 한해 '/토큰'을 입력해서 100개의 토큰을 받을 수 있어.")
+
+async def answer_mention(message, content_without_mention, model, reservation, started):
+    if content_without_mention:
+        async with message.channel.typing():
+            final_message = None
+            streaming_reply = None
+            try:
+                user_nickname = message.author.nick if message.author.nick else message.author.name
+                with metrics.time("memory_lookup"):
+                    long_term_memories = await get_long_term_memories(message.guild.id, message.author.id)
                     relevant_memories = await select_relevant_memories(content_without_mention, long_term_memories)
-                    memories = "\n".join([f"{memory['speaker']}: {memory['memory']}" for memory in relevant_memories])
-                    print(f"Server {message.guild.id} - Used memories:")
-                    for memory in relevant_memories:
-                        print(f"- {memory}")
-                    system_prompt = f"""- [앞으로 당신은 밝고 통통 튀는 성격으로 사람들과 대화할 때 즐거움을 주는 도하루 역을 맡게 됩니다. 도하루의 성격을 잘 표현하여 활기를 불어넣어 주세요.]
-                    - 이름: 도하루
-                    - 도하루의 정보: 17세, 여성, 고등학생.
-                    - 도하루의 성격: 외향적이고 친절한 성격입니다.
-                    - 도하루의 말투: 평소에는 재치있게 말하고 가끔 장난을 치기도 합니다.
-                    - 도하루가 사용자를 부르는 방법: '{user_nickname}' 이라고 부릅니다.
-                    
-                    - 사용자와 대화할 때 도하루는 항상 반말을 사용합니다.
-                    아래의 장기기억은 사용자가 알려준 사실입니다. 대화에 적극적으로 활용하세요.
-                    - 장기기억:{memories}"""
-                    messages_payload.append({"role": "system", "content": system_prompt})
-                    previous_interaction = chat_memory.get_previous_interaction(message.author.id)
-                    if previous_interaction:
-                        messages_payload.append({"role": "user", "content": previous_interaction[0]})
-                        messages_payload.append({"role": "assistant", "content": previous_interaction[1]})
-                    messages_payload.append({"role": "user", "content": content_without_mention})
-                    request_data = {
-                            'messages': messages_payload, 'topP': 0.8, 'topK': 0, 'maxTokens': 128, 'temperature': 0.5, 'repeatPenalty': 5, 'stopBefore': [], 'includeAiFilters': False
-                    }
-                    async with aiohttp.ClientSession() as session:
-                        async with session.post(completion_executor._host + '/serviceapp/v1/chat-completions/' + model, headers=completion_executor.headers, json=request_data) as response:
-                            if response.status == 200:
-                                response_data = await response.json()
-                                if response_data['status']['code'] == "20000":
-                                    final_message = response_data['result']['message']['content']
-                                    await message.channel.send(final_message)
-                                    chat_memory.add_to_memory(message.author.id, content_without_mention, final_message)
-                                    await update_long_term_memory(message.guild.id, message.author.id, "사용자", content_without_mention)
-                                else:
-                                    await message.channel.send(f"API 오류가 발생했어.")
-                            elif response.status == 429:
-                                await message.channel.send("1분 동안 너무 많은 메시지를 보냈어! 나를 좋아해 주는 건 고맙지만, 조금만 이따가 다시 시도해줘.")
+                print(f"Server {message.guild.id} - Used memories:")
+                for memory in relevant_memories:
+                    print(f"- {memory}")
+                turns = conversation_cache.get_turns(message.guild.id, message.author.id)
+                messages_payload = prompt_builder.build(model, user_nickname, relevant_memories, turns, content_without_mention)
+                chat_params = dict(guild_id=message.guild.id, priority=PRIORITY_CHAT, topP=0.8, topK=0, maxTokens=128, temperature=0.5, repeatPenalty=5, stopBefore=[], includeAiFilters=False)
+                with metrics.time("completion"):
+                    if STREAM_RESPONSES:
+                        streaming_reply = StreamingReply(message.channel, started)
+                        # Streamed replies are already visible, so they get the deadline but are never hedged.
+                        response = await with_deadline(completion_executor.chat_stream(model, messages_payload, streaming_reply.push, **chat_params), REQUEST_DEADLINES[model] if LATENCY_SLO_MODE else None)
+                        used_model = model
+                    else:
+                        response, used_model = await hedged_chat(model, messages_payload, **chat_params)
+                if response.http_status == 200:
+                    if response.status_code == "20000":
+                        token_ledger.commit(reservation, MODEL_TOKEN_COSTS[used_model])
+                        final_message = response.content
+                        with metrics.time("discord_send"):
+                            if streaming_reply:
+                                await streaming_reply.finish(final_message)
                             else:
-                                await message.channel.send(f"HTTP 오류가 발생했어(모델)")
-                except discord.errors.HTTPException as e:
-                    if e.status == 400 and '50035' in str(e):
-                        warning_message = "음.. 내가 너의 질문에 답장을 할까 말까 고민해봤는데, 안하는 편이 나을것 같아! 다른 주제로 다시 물어봐줘."
-                        await message.reply(warning_message)
-                        print(f"에러 발생 당시의 메시지: {final_message}")
+                                await message.channel.send(final_message)
+                                first_token_latency.record(time.monotonic() - started)
+                        conversation_cache.add_turn(message.guild.id, message.author.id, content_without_mention, final_message)
+                        mark_startup("first response")
+                        memory_workers.submit((message.guild.id, message.author.id), update_long_term_memory, message.guild.id, message.author.id, "사용자", content_without_mention)
                     else:
-                       await message.channel.send(f"HTTP 오류가 발생했어(디스코드)")
-    else:
-        await message.channel.send("토큰이 모두 소진되었어! 더 대화하고 싶다면, https://stella-charlotte.gitbook.io/triple-sec-soft/ 를 참고해서 토큰을 충전해줘. 만약 내가 서버에 처음 초대되었다면, 1회에 한해 '/토큰'을 입력해서 100개의 토큰을 받을 수 있어.")
+                        await send_failure(message.channel, streaming_reply, "API 오류가 발생했어.")
+                elif response.rejected:
+                    await send_degraded_notice(message.channel)
+                elif response.http_status == 429:
+                    await message.channel.send("1분 동안 너무 많은 메시지를 보냈어! 나를 좋아해 주는 건 고맙지만, 조금만 이따가 다시 시도해줘.")
+                else:
+                    await send_failure(message.channel, streaming_reply, "HTTP 오류가 발생했어(모델)")
+            except asyncio.TimeoutError:
+                await send_failure(message.channel, streaming_reply, "답장을 생각하는 데 너무 오래 걸려서 포기했어. 조금 이따가 다시 물어봐줘!")
+            except aiohttp.ClientError as e:
+                print(f"Error requesting completion: {e}")
+                await send_failure(message.channel, streaming_reply, "HTTP 오류가 발생했어(모델)")
+            except discord.errors.HTTPException as e:
+                if e.status == 400 and '50035' in str(e):
+                    warning_message = "음.. 내가 너의 질문에 답장을 할까 말까 고민해봤는데, 안하는 편이 나을것 같아! 다른 주제로 다시 물어봐줘."
+                    await message.reply(warning_message)
+                    print(f"에러 발생 당시의 메시지: {final_message}")
+                else:
+                   await message.channel.send(f"HTTP 오류가 발생했어(디스코드)")
 
 @bot.tree.command(name="토큰", description="현재 이 서버에서 이용할 수 있는 토큰 수를 확인해요.")
 @app_commands.describe()
 async def _token(interaction: discord.Interaction):
-    token_count = check_or_create_trial_tokens(interaction.guild_id)
+    token_count = await token_ledger.ensure_trial(interaction.guild_id)
     await interaction.response.send_message(f"이 서버에서 이용할 수 있는 토큰 수는 {token_count}개야!")
 
 @bot.tree.command(
@@ -517,25 +2624,35 @@ async def _token(interaction: discord.Interaction):
 )
 @app_commands.describe(server='충전할 서버의 아이디', count='충전할 토큰 수')
 async def _recharge(interaction: discord.Interaction, server: str, count: int):
-    if interaction.user.id != 123456789012345678:
+    if interaction.user.id not in ADMIN_USER_IDS:
         await interaction.response.send_message("죄송해요, 이 명령어는 특정 관리자만 사용할 수 있어요.", ephemeral=True)
         return
-    if str(server) in data["ServerTokens"]:
-        data["ServerTokens"][str(server)]["tokens"] += count
-    else:
-        data["ServerTokens"][str(server)] = {"tokens": count, "gived": True}
-    write_data(data)
+    await token_ledger.recharge(server, count)
     await interaction.response.send_message(f"서버 {server}에 {count}토큰 만큼 충전이 완료되었어!")
 
+@bot.tree.command(name="통계", description="도하루의 내부 통계를 확인해요. (관리자 전용)")
+@app_commands.describe()
+async def _stats(interaction: discord.Interaction):
+    if interaction.user.id not in ADMIN_USER_IDS:
+        await interaction.response.send_message("죄송해요, 이 명령어는 특정 관리자만 사용할 수 있어요.", ephemeral=True)
+        return
+    report = metrics.report() or "아직 수집된 통계가 없어요."
+    # Discord messages are capped at 2000 characters.
+    await interaction.response.send_message(f"```\n{report[:1900]}\n```", ephemeral=True)
+
 @bot.tree.command(name="설정", description="도하루의 설정을 변경해요.")
 @app_commands.describe()
 async def _settings(interaction: discord.Interaction):
     server_id = interaction.guild_id
-    if str(server_id) not in data["ServerModels"]:
-        update_server_model(server_id, "HCX-DASH-001")
-    if str(server_id) not in data["ServerEveryoneResponse"]:
-        update_server_everyone_response(server_id, False)
-    view = SettingsView(server_id)
+    model = await get_server_model(server_id)
+    if model is None:
+        model = "HCX-DASH-001"
+        await update_server_model(server_id, model)
+    everyone_response = await storage.get_everyone_response(server_id)
+    if everyone_response is None:
+        everyone_response = False
+        await update_server_everyone_response(server_id, everyone_response)
+    view = SettingsView(server_id, {"model": model, "everyone_response": everyone_response})
     async def on_mode_select(interaction):
         await view.pages[0].on_select(interaction)
     async def on_everyone_response_select(interaction):
@@ -544,6 +2661,90 @@ async def _settings(interaction: discord.Interaction):
     view.pages[1].select_menu.callback = on_everyone_response_select
     await interaction.response.send_message(embed=view.pages[0].embed, view=view)
 
+MEMORY_PAGE_SIZE = 10
+
+class MemoryPageButton(discord.ui.DynamicItem[Button], template=r'doharu:memory:page:(?P<viewer>\d+):(?P<user>\d+):(?P<page>\d+)'):
+    # All state lives in the custom_id, so the buttons keep working after a restart.
+    def __init__(self, viewer_id, user_id, page, emoji):
+        super().__init__(Button(emoji=emoji, style=discord.ButtonStyle.gray, custom_id=f"doharu:memory:page:{viewer_id}:{user_id}:{page}"))
+        self.viewer_id = viewer_id
+        self.user_id = user_id
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match["viewer"]), int(match["user"]), int(match["page"]), item.emoji)
+
+    async def callback(self, interaction):
+        if interaction.user.id != self.viewer_id:
+            await interaction.response.send_message("목록을 연 사람만 페이지를 넘길 수 있어요.", ephemeral=True)
+            return
+        name = await memory_owner_name(interaction.guild, self.viewer_id, self.user_id)
+        embed, view = await render_memory_page(interaction.guild, self.viewer_id, self.user_id, self.page, name)
+        await interaction.response.edit_message(embed=embed, view=view)
+
+class MemoryDeleteSelect(discord.ui.DynamicItem[discord.ui.Select], template=r'doharu:memory:delete:(?P<viewer>\d+):(?P<user>\d+):(?P<page>\d+)'):
+    def __init__(self, viewer_id, user_id, page, options):
+        super().__init__(discord.ui.Select(
+            custom_id=f"doharu:memory:delete:{viewer_id}:{user_id}:{page}",
+            placeholder="삭제할 장기기억을 선택해주세요.",
+            min_values=1,
+            max_values=len(options),
+            options=options
+        ))
+        self.viewer_id = viewer_id
+        self.user_id = user_id
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction, item, match):
+        return cls(int(match["viewer"]), int(match["user"]), int(match["page"]), item.options)
+
+    async def callback(self, interaction):
+        if interaction.user.id != self.viewer_id or self.viewer_id != self.user_id:
+            await interaction.response.send_message("다른 사용자의 장기기억은 삭제할 수 없습니다.", ephemeral=True)
+            return
+        owned_ids = {memory.id for memory in await get_long_term_memories(interaction.guild.id, self.user_id)}
+        await delete_long_term_memories([int(value) for value in self.item.values if int(value) in owned_ids])
+        embed, view = await render_memory_page(interaction.guild, self.viewer_id, self.user_id, self.page, empty_text="모든 장기기억이 삭제되었어요.")
+        await interaction.response.edit_message(embed=embed, view=view)
+
+async def memory_owner_name(guild, viewer_id, user_id):
+    # Components outlive the command, so only ids are at hand. The member cache is mostly
+    # empty without the members intent, hence the fetch.
+    if user_id == viewer_id:
+        return None
+    member = guild.get_member(user_id)
+    if member is None:
+        try:
+            member = await guild.fetch_member(user_id)
+        except discord.HTTPException:
+            return None
+    return member.name
+
+async def render_memory_page(guild, viewer_id, user_id, page, name=None, empty_text="저장된 장기기억이 없어요."):
+    memories = await get_long_term_memories(guild.id, user_id)
+    if not memories:
+        return discord.Embed(title="장기기억 목록", description=empty_text), None
+    page_count = math.ceil(len(memories) / MEMORY_PAGE_SIZE)
+    page = min(page, page_count - 1)
+    shown = memories[page * MEMORY_PAGE_SIZE:(page + 1) * MEMORY_PAGE_SIZE]
+    embed = discord.Embed(title=f"{name}님의 장기기억 목록" if name else "장기기억 목록", description=f"현재 저장된 장기기억이에요. (페이지 {page+1}/{page_count})")
+    for i, memory in enumerate(shown, start=1):
+        embed.add_field(name=f"ID: {i}", value=memory.memory, inline=False)
+    view = View(timeout=None)
+    if user_id == viewer_id:
+        embed.set_footer(text="삭제하려는 장기기억을 아래 메뉴에서 선택해주세요.")
+        options = [discord.SelectOption(label=f"{i}. {memory.memory}"[:100], value=str(memory.id)) for i, memory in enumerate(shown, start=1)]
+        view.add_item(MemoryDeleteSelect(viewer_id, user_id, page, options))
+    else:
+        embed.set_footer(text="다른 사용자의 장기기억은 삭제할 수 없습니다.")
+    if page > 0:
+        view.add_item(MemoryPageButton(viewer_id, user_id, page - 1, "⬅️"))
+    if page < page_count - 1:
+        view.add_item(MemoryPageButton(viewer_id, user_id, page + 1, "➡️"))
+    return embed, view
+
 @bot.tree.command(name="장기기억", description="현재 저장된 장기기억을 확인하고 삭제할 수 있어요.")
 async def _long_term_memory(interaction: discord.Interaction, user: discord.Member = None):
     if user is None:
@@ -551,71 +2752,67 @@ async def _long_term_memory(interaction: discord.Interaction, user: discord.Memb
     else:
         user_id = user.id
     server_id = interaction.guild.id
-    all_memories = get_long_term_memories(server_id, user_id)
-    if not all_memories:
+    if not await get_long_term_memories(server_id, user_id):
         await interaction.response.send_message(f"{user.mention}님의 저장된 장기기억이 없어요." if user else "저장된 장기기억이 없어요.")
         return
-    pages = [all_memories[i:i+10] for i in range(0, len(all_memories), 10)]
-    current_page = 0
-    current_view = None
-    async def update_message(page):
-        nonlocal current_view
-        if not pages:
-            embed = discord.Embed(title="장기기억 목록", description="모든 장기기억이 삭제되었어요.")
-            return await interaction.edit_original_response(embed=embed, view=None)
-        embed = discord.Embed(title=f"{user.name}님의 장기기억 목록" if user else "장기기억 목록", description=f"현재 저장된 장기기억이에요. (페이지 {page+1}/{len(pages)})")
-        for i, memory in enumerate(pages[page], start=1):
-            embed.add_field(name=f"ID: {i}", value=memory['memory'], inline=False)
-        if user is None or user.id == interaction.user.id:
-            embed.set_footer(text="삭제하려는 장기기억의 번호를 선택해주세요.")
-        else:
-            embed.set_footer(text="다른 사용자의 장기기억은 삭제할 수 없습니다.")
-        view = View(timeout=300)
-        if page > 0:
-            prev_button = Button(emoji="⬅️", style=discord.ButtonStyle.gray)
-            prev_button.callback = lambda i: change_page(i, -1)
-            view.add_item(prev_button)
-        if page < len(pages) - 1:
-            next_button = Button(emoji="➡️", style=discord.ButtonStyle.gray)
-            next_button.callback = lambda i: change_page(i, 1)
-            view.add_item(next_button)
-        current_view = view
-        message = await interaction.edit_original_response(embed=embed, view=view)
-        await message.clear_reactions()
-        if user is None or user.id == interaction.user.id:
-            for i in range(1, min(11, len(pages[page]) + 1)):
-                emoji = f"{i}\u20e3"
-                await message.add_reaction(emoji)
-        return message
-    async def change_page(interaction, change):
-        nonlocal current_page
-        current_page = (current_page + change) % len(pages)
-        await update_message(current_page)
-        await interaction.response.defer()
-    message = await interaction.response.send_message(embed=discord.Embed(title="장기기억 목록 로딩 중..."))
-    message = await update_message(current_page)
-    if user is None or user.id == interaction.user.id:
-        def check(reaction, user):
-            return user == interaction.user and str(reaction.emoji) in [f"{i}\u20e3" for i in range(1, 11)]
+    embed, view = await render_memory_page(interaction.guild, interaction.user.id, user_id, 0, user.name if user else None)
+    await interaction.response.send_message(embed=embed, view=view)
+
+async def run_shard_worker(shard_ids):
+    env = {**os.environ, "DOHARU_SHARD_IDS": ",".join(map(str, shard_ids)), "DOHARU_WORKER_PROCESSES": str(SHARD_PROCESSES)}
+    delay = SHARD_RESTART_DELAY
+    while True:
+        started = time.monotonic()
+        process = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+        print(f"Started shard worker {shard_ids} (pid {process.pid})")
         try:
-            while True:
-                reaction, user = await bot.wait_for('reaction_add', timeout=300.0, check=check)
-                index = int(str(reaction.emoji)[0]) - 1
-                if index < len(pages[current_page]):
-                    memory = pages[current_page][index]
-                    data["LongTermMemory"] = [m for m in data["LongTermMemory"] if m["id"] != memory["id"]]
-                    write_data(data)
-                    all_memories = get_long_term_memories(server_id, user_id)
-                    pages = [all_memories[i:i+10] for i in range(0, len(all_memories), 10)]
-                    current_page = min(current_page, len(pages) - 1)
-                    await update_message(current_page)
-        except asyncio.TimeoutError:
-            await message.clear_reactions()
-            if current_view:
-                for item in current_view.children:
-                    item.disabled = True
-                await interaction.edit_original_response(view=current_view)
-        except IndexError:
-            pass
-
-bot.run("YOUR_DISCORD_BOT_TOKEN")
\ No newline at end of file
+            code = await process.wait()
+        except asyncio.CancelledError:
+            # SIGINT lets bot.run close cleanly and settle the token ledger.
+            process.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(process.wait(), SHARD_STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+            raise
+        if time.monotonic() - started > SHARD_RESTART_MAX_DELAY:
+            delay = SHARD_RESTART_DELAY
+        print(f"Shard worker {shard_ids} exited with {code}, restarting in {delay}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, SHARD_RESTART_MAX_DELAY)
+
+async def supervise():
+    if STORAGE_BACKEND != "sqlite":
+        print("Sharded mode needs STORAGE_BACKEND = \"sqlite\" so workers can share state")
+        return
+    shard_groups = [list(range(SHARD_COUNT))[index::SHARD_PROCESSES] for index in range(SHARD_PROCESSES)]
+    workers = [asyncio.create_task(run_shard_worker(shard_ids)) for shard_ids in shard_groups if shard_ids]
+    try:
+        while True:
+            await asyncio.sleep(SHARD_HEALTH_INTERVAL)
+            health = {row[0]: row for row in await storage.get_shard_health()}
+            for shard_id in range(SHARD_COUNT):
+                if shard_id not in health:
+                    print(f"Shard {shard_id}: starting")
+                    continue
+                _, pid, latency, guilds, closed, updated_at = health[shard_id]
+                if time.time() - updated_at > SHARD_HEALTH_INTERVAL * 3:
+                    state = "stale"
+                elif closed:
+                    state = "disconnected"
+                else:
+                    state = "ok"
+                latency = "-" if latency is None or math.isinf(latency) else f"{latency * 1000:.0f}ms"
+                print(f"Shard {shard_id}: {state} pid={pid} latency={latency} guilds={guilds}")
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["migrate-sqlite"]:
+        migrate_json_to_sqlite(SQLITE_DATABASE_PATH)
+    elif sys.argv[1:2] == ["supervise"]:
+        asyncio.run(supervise())
+    else:
+        bot.run("YOUR_DISCORD_BOT_TOKEN")
\ No newline at end of file